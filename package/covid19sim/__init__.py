@@ -0,0 +1,6 @@
+"""Simulation of Covid-19 with individual reproduction and communities."""
+__version__ = "0.3.0"
+
+from covid19sim.parallel import sweep, scenario_grid, SharedPopulation
+from covid19sim.tree import scenario_tree
+from covid19sim.calibration import calibrate
@@ -0,0 +1,237 @@
+"""Calibration of the change points of r to realized data."""
+import os
+import shutil
+import tempfile
+import datetime
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from covid19sim import coronalib
+from covid19sim.parallel import _init_worker, _run_scenario
+
+# Columns of the daily results and of realized compared by the loss
+SERIES = {"cases": ("Erwartete Neu-Meldefälle", "Fälle"),
+          "icu": ("ICU", "Intensiv")}
+
+
+def loss(groupresults, realized, weights=None):
+    """Return the distance between a simulation and the realized data.
+
+    The loss is the weighted sum of the mean squared differences of
+    log(1 + x) of the expected new reported cases and the realized cases
+    ("Fälle") and of the expected icu patients and the realized icu
+    patients ("Intensiv") on all dates with realized data.
+
+    Parameters
+    ----------
+    groupresults : daily results of sim
+    realized : dataframe with the columns "Meldedatum", "Fälle" and
+        optionally "Intensiv" (missing values are skipped)
+    weights : dictionary with the weight of "cases" and "icu", default is 1
+        for both
+
+    Returns
+    -------
+    loss : float, inf if no date of realized is simulated
+    """
+    if weights is None:
+        weights = {"cases": 1.0, "icu": 1.0}
+    merged = groupresults.merge(realized, left_on="Datum",
+                                right_on="Meldedatum", how="inner",
+                                suffixes=("", " (Ist)"))
+    total = 0.0
+    used = False
+    for key, weight in weights.items():
+        simcol, realcol = SERIES[key]
+        if weight == 0 or realcol not in merged:
+            continue
+        real = np.asarray(merged[realcol], dtype=float)
+        if simcol in merged:
+            expected = np.asarray(merged[simcol], dtype=float)
+        else:
+            expected = np.zeros(len(real))
+        select = ~np.isnan(real)
+        if not np.any(select):
+            continue
+        total += weight * np.mean((np.log1p(np.maximum(expected[select], 0)) -
+                                   np.log1p(np.maximum(real[select], 0)))**2)
+        used = True
+    return total if used else np.inf
+
+
+def calibrate(realized, population, r_change, alpha=0.2, rep_delay=8.7,
+              fit=None, weights=None, rounds=3, ncand=9, step=0.3,
+              workers=None, seed=None, datadir=None, **kwargs):
+    """Fit the change points of r, alpha and rep_delay to realized data.
+
+    The parameters are fitted one after the other (coordinate descent). For
+    each parameter ncand candidate values around the current value are
+    simulated in a process pool and the candidate with the smallest loss is
+    kept. The search interval shrinks by half in each round. All candidates
+    use the same random numbers.
+
+    The population is sent once to each worker process. For a change point
+    after day0 the history up to the day before the change point is
+    simulated once and all candidates continue from its checkpoint.
+
+    Parameters
+    ----------
+    realized : dataframe with the realized data (see loss)
+    population : dictionary or SharedPopulation with the arrays "age",
+        "drate", "contacts" and optionally "hnr" (see sweep)
+    r_change : dictionary with the dates of the change points as keys and
+        the start values of the multipliers of the normalised contacts
+    alpha, rep_delay : start values of alpha and rep_delay
+    fit : list of the parameters to fit, dates of r_change, "alpha" and
+        "rep_delay", default are all
+    weights : weights of the loss
+    rounds : number of rounds over all parameters
+    ncand : number of candidates per parameter and round
+    step : relative half width of the search interval in the first round
+    workers : number of worker processes, default is the number of cpus
+    seed : seed of the random numbers of all candidates
+    datadir : directory of the checkpoints, by default a temporary
+        directory which is removed afterwards
+    kwargs : other keyword arguments of sim (e.g. nday, day0date,
+        com_attack_rate)
+
+    Returns
+    -------
+    best : dictionary with the fitted "r_change", "alpha", "rep_delay" and
+        the "loss"
+    history : dataframe with the loss ("Verlust") of all candidates per
+        round ("Runde"), parameter and value ("Wert")
+    """
+    if any(np.ndim(r) != 0 for r in r_change.values()):
+        raise ValueError("calibrate requires numeric values of r_change")
+    if fit is None:
+        fit = list(r_change.keys()) + ["alpha", "rep_delay"]
+    for param in fit:
+        if param not in r_change and param not in ("alpha", "rep_delay"):
+            raise ValueError("Unknown parameter: " + str(param))
+    if workers is None:
+        workers = os.cpu_count()
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    day0date = kwargs.get("day0date", inspect.signature(
+        coronalib.sim).parameters["day0date"].default)
+
+    current = {"r_change": dict(r_change), "alpha": alpha,
+               "rep_delay": rep_delay}
+    fitter = {"realized": realized, "weights": weights, "seed": seed,
+              "kwargs": kwargs, "history": []}
+    tmpdir = None
+    if datadir is None:
+        tmpdir = datadir = tempfile.mkdtemp()
+    fitter["datadir"] = datadir
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(population,)) as pool:
+            fitter["pool"] = pool
+            best = _evaluate(fitter, [current], None)[0]
+            for j in range(rounds):
+                factors = 1 + step / 2**j * np.linspace(-1, 1, ncand)
+                factors = np.unique(np.append(factors, 1.0))
+                for param in fit:
+                    candidates = [_candidate(current, param, value)
+                                  for value in _values(current, param,
+                                                       factors)]
+                    resume = None
+                    if param in r_change:
+                        resume = _prefix(fitter, current, param, day0date)
+                    losses = _evaluate(fitter, candidates, resume)
+                    for candidate, value in zip(candidates, losses):
+                        fitter["history"].append({
+                            "Runde": j + 1, "Parameter": param,
+                            "Wert": _value(candidate, param),
+                            "Verlust": value})
+                    k = int(np.argmin(losses))
+                    if losses[k] < best:
+                        best = losses[k]
+                        current = candidates[k]
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result = dict(current)
+    result["loss"] = best
+    return result, pd.DataFrame(fitter["history"])
+
+
+def _value(params, param):
+    """Return the value of a parameter."""
+    if param in ("alpha", "rep_delay"):
+        return params[param]
+    return params["r_change"][param]
+
+
+def _values(params, param, factors):
+    """Return the candidate values of a parameter."""
+    values = _value(params, param) * factors
+    if param == "alpha":
+        values = np.minimum(values, 1.0)
+    return np.unique(values[values > 0])
+
+
+def _candidate(params, param, value):
+    """Return a copy of params with a new value of param."""
+    candidate = dict(params)
+    candidate["r_change"] = dict(params["r_change"])
+    if param in ("alpha", "rep_delay"):
+        candidate[param] = float(value)
+    else:
+        candidate["r_change"][param] = float(value)
+    return candidate
+
+
+def _scenario(fitter, params, name):
+    """Return the keyword arguments of sim for the parameters."""
+    scenario = dict(fitter["kwargs"])
+    scenario.update(r_change=params["r_change"], alpha=params["alpha"],
+                    rep_delay=params["rep_delay"], simname=name,
+                    datadir=fitter["datadir"])
+    return scenario
+
+
+def _prefix(fitter, params, param, day0date):
+    """Simulate the history before the change point param once.
+
+    Returns
+    -------
+    resume : checkpoint of the day before the change point or None if the
+        change point is not after day0, is the first change point (its r is
+        used from day 0 on) or is not reached
+    """
+    day = (datetime.datetime.strptime(param, "%Y-%m-%d").date() -
+           day0date).days
+    first = min(params["r_change"].keys(), key=lambda x:
+                datetime.datetime.strptime(x, "%Y-%m-%d").date())
+    if day < 1 or param == first:
+        return None
+    forkfile = os.path.join(fitter["datadir"], "Prefix_fork.ckpt")
+    if os.path.exists(forkfile):
+        os.remove(forkfile)
+    scenario = _scenario(fitter, params, "Prefix")
+    scenario["fork_day"] = day
+    fitter["pool"].submit(_run_scenario, 0, scenario, fitter["seed"],
+                          []).result()
+    return forkfile if os.path.exists(forkfile) else None
+
+
+def _evaluate(fitter, candidates, resume):
+    """Return the losses of the candidates, evaluated in the pool."""
+    futures = []
+    for k, params in enumerate(candidates):
+        scenario = _scenario(fitter, params, "Kandidat " + str(k))
+        scenario["resume"] = resume
+        futures.append(fitter["pool"].submit(
+            _loss_scenario, scenario, fitter["seed"], fitter["realized"],
+            fitter["weights"]))
+    return [future.result() for future in futures]
+
+
+def _loss_scenario(scenario, seed, realized, weights):
+    """Simulate a scenario in a worker process and return its loss."""
+    return loss(_run_scenario(0, scenario, seed, []), realized, weights)
@@ -0,0 +1,233 @@
+"""Aggregate simulation of cohorts.
+
+The population is represented by the number of persons in each group of
+population_germany.csv (age, gender, family status and contact level) and
+the new infections per group and day. The states of the infected persons
+follow from the probabilities of the pathways of the individual model
+(icu admission, icu discharge, Covid-19 death and recovery) as function of
+the days since infection. The daily results are the expectations of the
+individual simulation coronalib.sim with the "current" population.
+"""
+import time
+import datetime
+import numpy as np
+import pandas as pd
+import pkg_resources
+from scipy.stats import poisson
+from scipy.signal import fftconvolve
+from IPython.display import display
+from covid19sim import coronalib
+from covid19sim.convolution import delay_kernel, delay_step
+from covid19sim.sinks import ExcelSink
+
+
+def makecohorts(n=1000000):
+    """Generate the cohorts of the population "current" of makepop.
+
+    Returns
+    -------
+    cohorts : dataframe with the number of persons ("count"), age, agegroup,
+        gender, family factor, normalised contacts and daily mortality rate
+        ("drate") of each group
+    """
+    germany = pkg_resources.resource_filename('covid19sim',
+                                              'population_germany.csv')
+    popi = coronalib.readgroups(germany, n)
+    popi = popi[popi.N1M > 0]
+    cohorts = pd.DataFrame({"count": popi.N1M, "age": popi.age,
+                            "agegroup": popi.agegroup,
+                            "gender": popi.gender,
+                            "family": popi.family_factor,
+                            "contacts": popi.contacts_mean,
+                            "drate": 1 - (1-popi.deathrate)**(1/365)})
+    # normalize contacts to a mean of one per person
+    cohorts["contacts"] = cohorts.contacts / np.average(
+        cohorts.contacts, weights=cohorts["count"])
+    return cohorts.reset_index(drop=True)
+
+
+def sim(cohorts, mean_serial=7.0, std_serial=3.4, nday=140, day0cumrep=20,
+        prob_icu=0.005, mean_days_to_icu=12, mean_time_to_death=17,
+        mean_duration_icu=10, immunt0=0.0, ifr=0.5, simname="test",
+        datadir=".", realized=None, rep_delay=8.7, alpha=0.2, r_change=None,
+        day0date=datetime.date(2020, 3, 15), headless=False, sinks=None):
+    """Simulate the expectations of the individual model for cohorts.
+
+    Parameters
+    ----------
+    cohorts : dataframe of makecohorts
+    r_change : dictionary with the r of each cohort at change points, keys
+        are the dates, values are vectors with one r per cohort or numbers,
+        which are multiplied with the normalised contacts
+
+    The other parameters are the same as in coronalib.sim (including
+    headless and sinks).
+
+    Returns
+    -------
+    counts : array of shape (ncohort, 8) with the expected number of persons
+        in each state per cohort at the last day
+    statesum : array of shape (8, nday) with the expected count of each
+        state per day
+    infections : array of length nday
+        the expected number of infections
+    day0 : the simulation day on which the number of cumulated reported
+        exceeds day0cumrep
+    re :  array of length nday
+        the effective reporoduction number per day
+    params : a copy of all input paramters as a data frame
+    results : daily results as a dataframe (None if headless)
+    """
+    # This must be the first line
+    args = locals()
+    tstart = time.time()
+    count = np.asarray(cohorts["count"], dtype=float)
+    age = np.asarray(cohorts["age"], dtype=float)
+    drate = np.asarray(cohorts["drate"])
+    contacts = np.asarray(cohorts["contacts"])
+    args["mean_age"] = np.average(age, weights=count)
+    n = np.sum(count)
+
+    # replace dates and numbers
+    changes = {}
+    for key, r in r_change.items():
+        newkey = datetime.datetime.strptime(key, "%Y-%m-%d").date()
+        if np.ndim(r) == 0:
+            r = r * contacts
+        changes[(newkey - day0date).days] = np.asarray(r)
+
+    # Initialize r
+    r = changes[min(changes.keys())]
+    rmean = np.average(r, weights=count)
+
+    # Precalculate profile infection
+    delay = delay_kernel("gamma", (mean_serial, std_serial), 28)
+    delay = np.ascontiguousarray(delay[::-1])
+
+    # Precalculate profile report
+    pdf = delay_kernel("gamma", (rep_delay, 1), 48)
+
+    # initial immun and infected persons, drawn with replacement
+    pinf = 1 - (1 - 1/n)**20
+    pimmun = 1 - (1 - 1/n)**int(immunt0*n)
+    newinfected = np.zeros(shape=(len(count), nday))
+    newinfected[:, 0] = count * pinf
+    susceptible = count * (1-pimmun) * (1-pinf)
+    immun = count * pimmun * (1-pinf)
+
+    statesum = np.zeros(shape=(8, nday))
+    statesum[0, 0] = np.sum(susceptible)
+    infections = np.zeros(shape=nday)
+    rexternal = np.zeros(shape=nday)
+    reported = np.zeros(shape=nday)
+    cumreported = 0.0
+    re = np.zeros(shape=nday)
+    infections[0] = np.sum(newinfected[:, 0])
+    day0 = -1
+
+    for i in range(1, nday):
+
+        # New infections on day i
+        imin = max(0, i-28)
+        h = infections[imin: i]
+        newinf = np.sum(h*delay[-len(h):])
+
+        newinfected[:, i] = susceptible * np.minimum(r * newinf / n, 1)
+        susceptible -= newinfected[:, i]
+        infections[i] = np.sum(newinfected[:, i])
+        statesum[0, i] = np.sum(susceptible)
+
+        rexternal[i] = rmean
+        if newinf > 0:
+            re[i] = infections[i] / newinf
+        else:
+            re[i] = 0
+
+        reported[i] = delay_step(infections, pdf, i, window=35) * alpha
+        cumreported += reported[i]
+
+        # find day0
+        if (cumreported > day0cumrep) and (day0 == -1):
+            day0 = i
+
+        # adjust r
+        if (day0 > -1) and ((i-day0) in changes.keys()):
+            r = changes[i-day0]
+            rmean = np.average(r, weights=count)
+
+    # Expected persons per cohort, state and day
+    pathway = _pathways(drate, count, nday, prob_icu, ifr, mean_days_to_icu,
+                        mean_time_to_death, mean_duration_icu)
+    states = {key: fftconvolve(newinfected, prob, axes=1)[:, :nday]
+              for key, prob in pathway.items()}
+    for key in [1, 2, 6, 7]:
+        statesum[key] = np.sum(states[key], axis=0)
+    statesum[1] += np.sum(immun)
+    newicu = np.sum(states["newicu"], axis=0)
+
+    counts = np.zeros(shape=(len(count), 8))
+    counts[:, 0] = susceptible
+    for key in [1, 2, 6, 7]:
+        counts[:, key] = states[key][:, -1]
+    counts[:, 1] += immun
+
+    argsnew = {}
+    for key, value in args.items():
+        if type(value) in [int, bool, float, str]:
+            argsnew[key] = value
+    if headless:
+        return counts, statesum, infections, day0, re, argsnew, None
+    agestats = coronalib._agestats(age, count - susceptible, counts[:, 7],
+                                   np.sum(states["newicu"], axis=1),
+                                   counts=True)
+    groupresults, results = coronalib._groupresults(
+        agestats, statesum, infections, newicu, re, rexternal, day0,
+        day0date, pdf, alpha, realized)
+    if sinks is None:
+        display(results)
+    groupresults = coronalib._write_results(
+        [ExcelSink(datadir)] if sinks is None else sinks, simname, argsnew,
+        results, groupresults)
+    if sinks is None:
+        print("Simulation time: " + str(time.time()-tstart))
+    return counts, statesum, infections, day0, re, argsnew, groupresults
+
+
+def _pathways(drate, count, nday, prob_icu, ifr, mean_days_to_icu,
+              mean_time_to_death, mean_duration_icu):
+    """Return the probabilities of the states by days since infection.
+
+    The probabilities follow the transitions of the dense engine of
+    coronalib.sim: icu admission on day time_to_icu if still infected,
+    discharge after time_on_icu days (never for 0 days), Covid-19 death
+    after time_to_death days and recovery after 28 days.
+
+    Returns
+    -------
+    pathway : dictionary with arrays of shape (ncohort, nday) for the states
+        1, 2, 6, 7 and the new icu admissions ("newicu")
+    """
+    a = np.arange(nday)
+    meanrate = np.sum(count * drate) / np.sum(count)
+    picu = np.minimum(drate / meanrate * prob_icu, 1)[:, None]
+    pdead = np.minimum(drate / meanrate * ifr, 1)[:, None]
+
+    # death after time_to_death < days infected
+    dead = pdead * poisson.cdf(a - 1, mean_time_to_death)
+    alive = 1 - dead
+
+    # admission on day t <= 28 and still on icu a-t days later
+    admission = np.where((a >= 1) & (a <= 28),
+                         poisson.pmf(a, mean_days_to_icu), 0)
+    stay = poisson.pmf(0, mean_duration_icu) +\
+        poisson.sf(a, mean_duration_icu)
+    onicu = np.convolve(admission, stay)[:nday]
+
+    pathway = {}
+    pathway[7] = dead
+    pathway[6] = alive * picu * onicu
+    pathway[2] = alive * (a <= 28) * (1 - picu * np.cumsum(admission))
+    pathway[1] = 1 - pathway[2] - pathway[6] - pathway[7]
+    pathway["newicu"] = picu * admission * (
+        1 - pdead * poisson.cdf(a - 2, mean_time_to_death))
+    return pathway
@@ -0,0 +1,126 @@
+"""Delay kernels and delay convolutions of daily time series.
+
+The reported cases, the expected deaths and the corrections of the case
+fatality rates distribute the daily values of a series over the following
+days with a delay kernel (e.g. a gamma or poisson pdf of the days between
+infection and report). The convolutions run along the last axis, leading
+axes (e.g. regions, replicas or several kernels) are evaluated together.
+
+The kernels are kept in a cache with the distribution, its parameters and
+the length as key, the least recently used kernels are removed first.
+"""
+import functools
+import numpy as np
+from scipy.signal import fftconvolve
+from scipy.stats import gamma, poisson
+
+# Kernels longer than this are convolved with the fft by method "auto"
+FFT_WINDOW = 64
+
+# Maximal number of kernels in the cache
+KERNEL_CACHE_SIZE = 256
+
+
+def delay_kernel(distribution, params, length):
+    """Return a delay kernel from the cache.
+
+    Parameters
+    ----------
+    distribution : "gamma_cdf" for the gamma distribution function at the
+        days 0, ..., length-1, "gamma" for the probabilities of the delays
+        1, ..., length (difference of the distribution function), "poisson"
+        for the probabilities of the delays 0, ..., length-1
+    params : tuple with mean and std of the gamma distribution or the mean of
+        the poisson distribution
+    length : number of values
+
+    Returns
+    -------
+    kernel : read-only array of length length
+    """
+    return _kernel(distribution, tuple(float(x) for x in params), int(length))
+
+
+def clear_kernels():
+    """Remove all kernels from the cache."""
+    _kernel.cache_clear()
+
+
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def _kernel(distribution, params, length):
+    """Calculate a delay kernel (see delay_kernel)."""
+    if distribution == "gamma_cdf":
+        mean, std = params
+        values = gamma.cdf(np.arange(length), a=mean**2/std**2,
+                           scale=std**2/mean)
+    elif distribution == "gamma":
+        x = _kernel("gamma_cdf", params, length + 1)
+        values = x[1:] - x[:-1]
+    elif distribution == "poisson":
+        values = poisson.pmf(np.arange(length), params[0])
+    else:
+        raise ValueError("Unknown distribution: " + str(distribution))
+    values.setflags(write=False)
+    return values
+
+
+def delay_convolve(values, kernel, window=None, method="auto"):
+    """Convolve daily values with a delay kernel along the last axis.
+
+    out[..., t] is the sum of values[..., t-s] * kernel[..., s] over
+    s < min(t, window). As in the reporting of sim, the values of day 0 are
+    not distributed.
+
+    Parameters
+    ----------
+    values : array of shape (..., nday) with the daily values
+    kernel : array of shape (..., nkernel) with the probability of each
+        delay, the leading axes are broadcast with the leading axes of values
+    window : number of delays used, default is the length of the kernel
+    method : "direct" adds the shifted series for each delay (same rounding
+        as the summation day by day), "fft" uses the fft convolution, "auto"
+        uses the fft for windows longer than FFT_WINDOW
+
+    Returns
+    -------
+    out : array of the broadcast shape with the convolved values
+    """
+    if method not in ("auto", "direct", "fft"):
+        raise ValueError("Unknown method: " + str(method))
+    values = np.array(values, dtype=float)
+    nday = values.shape[-1]
+    if window is None:
+        window = np.shape(kernel)[-1]
+    kernel = np.asarray(kernel, dtype=float)[..., :min(window, nday)]
+    window = kernel.shape[-1]
+    values[..., 0] = 0
+    if method == "auto":
+        method = "fft" if window > FFT_WINDOW else "direct"
+
+    if method == "fft":
+        shape = np.broadcast_shapes(values.shape[:-1], kernel.shape[:-1])
+        return fftconvolve(np.broadcast_to(values, shape + (nday,)),
+                           np.broadcast_to(kernel, shape + (window,)),
+                           axes=-1)[..., :nday]
+
+    out = np.zeros(np.broadcast_shapes(values.shape[:-1], kernel.shape[:-1]) +
+                   (nday,))
+    for s in range(window):
+        out[..., s:] += values[..., :nday-s] * kernel[..., s, None]
+    return out
+
+
+def delay_step(values, kernel, t, window=None):
+    """Return the delay convolution of day t (see delay_convolve).
+
+    Only the values up to day t are used, so the function can be called
+    during a simulation when the values of the following days are not known
+    yet.
+    """
+    if window is None:
+        window = np.shape(kernel)[-1]
+    m = min(t, window)
+    if m == 0:
+        return np.zeros(np.shape(values)[:-1])
+    h = values[..., t-m+1:t+1]
+    return np.sum(h[..., ::-1] * kernel[:m], axis=-1)
@@ -4,15 +4,21 @@ import datetime
 import warnings
 import pandas as pd
 import numpy as np
-from scipy.stats import gamma
 import plotly.graph_objects as go
 from plotly.offline import plot
 from plotly.subplots import make_subplots
 import plotly.io as pio
-import scipy.stats
 from IPython.display import display
 import pkg_resources
+from covid19sim import fused
+from covid19sim.convolution import delay_convolve, delay_step, delay_kernel
+from covid19sim.sinks import ExcelSink
 import os
+import sys
+import pickle
+import shutil
+import hashlib
+from covid19sim import __version__
 
 warnings.filterwarnings("ignore")
 
@@ -27,20 +33,39 @@ STATEDEF_DE = {0: "nicht infiziert", 1: "immun", 2: "infiziert",
 
 STATEDEF = STATEDEF_DE
 
+# Variables of sim saved in a checkpoint
+_CHECKPOINT = ["state", "statesum", "firstdayinfected", "firstdayicu",
+               "time_to_icu", "time_to_death", "time_on_icu", "go_to_icu",
+               "go_dead", "infections", "rexternal", "newicu", "reported",
+               "re", "day0", "rkey", "com_attack_now", "active",
+               "active_last", "calendar", "statecount", "strata",
+               "firstdayhnr", "com_days_to_infection", "ranscom",
+               "hhbuckets", "extinct", "stopday",
+               "cumreported"]
+
 
 def infection_profile(mean_serial=7.0, std_serial=3.4, nday=21):
     """Calc the infections profile."""
-    gamma_a = mean_serial**2/std_serial**2
-    gamma_scale = std_serial**2/mean_serial
     xval = np.linspace(0, nday, num=nday+1, dtype=("int"))
-    yval = gamma.cdf(xval, a=gamma_a, scale=gamma_scale)
+    yval = np.array(delay_kernel("gamma_cdf", (mean_serial, std_serial),
+                                 nday+1))
     delay = np.zeros(nday+1)
-    delay[1:(nday+1)] = yval[1:(nday+1)] - yval[0:nday]
+    delay[1:(nday+1)] = delay_kernel("gamma", (mean_serial, std_serial), nday)
     return xval, yval, delay
 
 
-def makepop(popname, n=1000000):
-    """Generate population."""
+def makepop(popname, n=1000000, store=None, store_size=None):
+    """Generate population.
+
+    With store, the columns are written to memory-mapped .npy files in a
+    subdirectory of store and returned as read-only memory-mapped arrays.
+    The subdirectory is named by popname, n and a hash of the source csv
+    file and the library version, an existing population is opened without
+    generating it again. store_size limits the size of all populations in
+    store (in bytes), the least recently used populations are removed.
+    """
+    if store is not None:
+        return _makepop_store(popname, n, store, store_size)
     if popname == "current":
         germany = pkg_resources.resource_filename('covid19sim',
                                                   'population_germany.csv')
@@ -59,6 +84,125 @@ def makepop(popname, n=1000000):
     return age, agegroup, gender, contacts, dr_day, hnr, persons
 
 
+def _makepop_store(popname, n, store, store_size=None):
+    """Generate a population into memory-mapped .npy files and open it."""
+    sources = {"current": "population_germany.csv",
+               "household": "population_household.csv"}
+    if popname not in sources:
+        print("Unknown population")
+        return None, None, None, None, None, None
+    source = pkg_resources.resource_filename('covid19sim', sources[popname])
+    directory = os.path.join(store, popname + "_" + str(n) + "_" +
+                             _store_key(source))
+    if not os.path.exists(os.path.join(directory, "complete")):
+        if popname == "current":
+            groups = readgroups(source, n)
+            counts = np.array(groups.N1M)
+            columns = {"age": np.asarray(groups.age, dtype="int16"),
+                       "agegroup": np.asarray(groups.agegroup,
+                                              dtype="int16"),
+                       "gender": np.asarray(groups.gender).astype(str),
+                       "contacts": groups.contacts_mean,
+                       "drate": 1 - (1-groups.deathrate)**(1/365)}
+        else:
+            groups = pd.read_csv(source)
+            counts = campus_counts(groups, n)
+            columns = _campus_columns(groups)
+            columns["drate"] = 1 - (1-columns["drate"])**(1/365)
+        columns["contacts"] = _normalize_contacts(columns["contacts"], counts)
+        # write to a temporary directory, concurrent processes keep the
+        # first complete population
+        tmpdir = directory + ".tmp" + str(os.getpid())
+        os.makedirs(tmpdir, exist_ok=True)
+        _store_groups(tmpdir, counts, columns)
+        open(os.path.join(tmpdir, "complete"), "w").close()
+        try:
+            os.rename(tmpdir, directory)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    # the time of the marker is the time of the last use
+    os.utime(os.path.join(directory, "complete"))
+    if store_size is not None:
+        _evict_store(store, store_size, directory)
+
+    population = {}
+    for key in ["age", "agegroup", "gender", "contacts", "drate", "hnr",
+                "persons"]:
+        filename = os.path.join(directory, key + ".npy")
+        if os.path.exists(filename):
+            population[key] = np.load(filename, mmap_mode="r")
+        else:
+            population[key] = None
+    return tuple(population.values())
+
+
+def _store_key(source):
+    """Return the hash of the source file and the library version."""
+    digest = hashlib.sha256(__version__.encode())
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def _evict_store(store, store_size, keep):
+    """Remove the least recently used populations of store until the size of
+    the remaining populations is at most store_size (keep is never
+    removed)."""
+    entries = []
+    for name in os.listdir(store):
+        directory = os.path.join(store, name)
+        marker = os.path.join(directory, "complete")
+        if os.path.exists(marker):
+            size = sum(os.path.getsize(os.path.join(directory, x))
+                       for x in os.listdir(directory))
+            entries.append((os.path.getmtime(marker), size, directory))
+    total = sum(entry[1] for entry in entries)
+    for used, size, directory in sorted(entries):
+        if total <= store_size:
+            break
+        if os.path.abspath(directory) != os.path.abspath(keep):
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+
+def _store_groups(directory, counts, columns, blocksize=2**22):
+    """Write the columns of the individuals to .npy files.
+
+    Each group is repeated counts times, the groups are written in blocks of
+    about blocksize individuals. The household numbers are made unique for
+    each repetition.
+    """
+    columns = {key: np.asarray(values) for key, values in columns.items()}
+    for key, values in columns.items():
+        if values.dtype == object:
+            columns[key] = values.astype(str)
+    ends = np.cumsum(counts)
+    arrays = {key: np.lib.format.open_memmap(
+        os.path.join(directory, key + ".npy"), mode="w+",
+        dtype=values.dtype, shape=(int(ends[-1]),))
+        for key, values in columns.items()}
+    if "hnr" in columns:
+        nhnr = np.max(columns["hnr"]) + 1
+    first = 0
+    while first < len(counts):
+        last = max(first + 1, np.searchsorted(ends, ends[first] + blocksize))
+        last = min(last, len(counts))
+        start = ends[first] - counts[first]
+        block = slice(start, ends[last-1])
+        for key, values in columns.items():
+            arrays[key][block] = np.repeat(values[first:last],
+                                           counts[first:last])
+        if "hnr" in columns:
+            replica = np.arange(block.stop - block.start) - np.repeat(
+                ends[first:last] - counts[first:last] - start,
+                counts[first:last])
+            arrays["hnr"][block] += replica * nhnr
+        first = last
+    for values in arrays.values():
+        values.flush()
+
+
 def makeprofile_plot(mean_serial=7, mean_std=3.4, r0=2.7, re=0.9, isoday=4):
     """Plot the infections profile."""
     inf1 = go.Figure()
@@ -109,7 +253,10 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
         mean_duration_icu=10, immunt0=0.0, ifr=0.5,
         long_term_death=False, hnr=None, com_attack_rate=0.6,
         simname="test", datadir=".", realized=None, rep_delay=8.7,
-        alpha=0.2, r_change=None, day0date=datetime.date(2020, 3, 15)):
+        alpha=0.2, r_change=None, day0date=datetime.date(2020, 3, 15),
+        engine="dense", lean=False, sampler="uniform", backend="numpy",
+        nrep=None, seed=None, rng=None, checkpoint_days=(), resume=None,
+        fork_day=None, stop_extinct=False, headless=False, sinks=None):
     """Simulate model.
 
     Parameters
@@ -137,6 +284,56 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
     r_change : dictionary with individual r at change points, keys are the
         dates, values are vectors of length n with individual r's
     day0date : date of day 0
+    engine : "dense" evaluates all transitions on the full population every
+        day, "active" keeps an index of the infected and icu individuals and
+        only evaluates those, "calendar" schedules the future transitions of
+        each individual at infection time and only processes the events due
+        on each day (identical results, cost scales with prevalence). Both
+        sparse engines generate household infections from a household index
+        only for households with an external infection.
+    lean : Flag to store the individual arrays with compact dtypes (int8
+        states, int16 day counters, bit-packed flags), identical results
+    sampler : "uniform" draws one random number per individual and day for
+        the external infections, "count" draws the number of infections per
+        stratum of equal r on the susceptibles and selects the infected
+        individuals within each stratum (statistically equivalent, cost
+        scales with the number of infections)
+    backend : "numpy" evaluates the dense engine with numpy array operations,
+        "numba" with a compiled kernel fusing the daily update in one pass
+        over the individuals (requires numba, identical results)
+    nrep : number of replicas simulated together as a leading axis of the
+        individual arrays, the population, the profiles and the change points
+        are shared, the random numbers and day0 differ per replica (requires
+        engine dense, sampler uniform and backend numpy). None simulates a
+        single run without the replica axis.
+    seed : seed (int or numpy SeedSequence) of the random numbers. Each
+        replica draws from its own PCG64 stream spawned from the root seed,
+        replica 0 of an ensemble equals the single run with the same seed.
+        If seed and rng are None the global numpy random state is used.
+    rng : numpy Generator of a single run or list of Generators with one
+        per replica, alternative to seed
+    checkpoint_days : simulation days after which the complete state of the
+        simulation (including the state of the random numbers) is written to
+        the file datadir/simname_<day>.ckpt
+    resume : checkpoint file to continue from, the other parameters must be
+        the same as in the interrupted run. The results are identical to an
+        uninterrupted run.
+    fork_day : change point (days after day0) at which a scenario tree
+        forks, the state before the change point is written to the file
+        datadir/simname_fork.ckpt and the simulation stops (requires nrep
+        None and fork_day > 0)
+    stop_extinct : Flag to stop the simulation of the individuals when no
+        infection occurred in the last 29 days (all replicas). Then there are
+        no infected individuals left and no new infections, the pending icu
+        discharges and Covid-19 deaths are added on their days and the
+        remaining days only update the reported cases and the change points
+        (identical results, requires long_term_death False). The stop day is
+        returned as parameter "stopday" (-1 without stop).
+    headless : Flag to only return the arrays without building the result
+        tables, without output and without timing messages
+    sinks : list of sinks (see covid19sim.sinks) receiving the result
+        tables, None writes the Excel file datadir/simname.xlsx, displays the
+        overview and prints the timing as before, [] only returns the tables
 
     Returns
     -------
@@ -158,12 +355,129 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
     re :  array of length nday
         the effective reporoduction number per day
     params : a copy of all input paramters as a data frame
-    results : daily results as a dataframe
+    results : daily results as a dataframe (None if headless)
+
+    With nrep, state, statesum, infections, day0 and re have the replica as
+    first axis (e.g. statesum of shape (nrep, 8, nday)) and the results have
+    an additional column "Lauf" with the replica.
     """
     # This must be the first line
     args = locals()
     args["mean_age"] = np.mean(age)
     tstart = time.time()
+    if headless and sinks:
+        raise ValueError("headless does not write to sinks")
+    params = {key: value for key, value in args.items()
+              if key not in ["headless", "sinks", "mean_age"]}
+    final = _exhaust(_simulate(**params))
+    state, statesum, infections, newicu, re, rexternal, firstdayicu = [
+        final[x] for x in ["state", "statesum", "infections", "newicu", "re",
+                           "rexternal", "firstdayicu"]]
+    day0, pdf, reps, workset, name = [
+        final[x] for x in ["day0", "pdf", "reps", "workset", "name"]]
+
+    args["stopday"] = final["stopday"]
+    args["workset_mb"] = workset / 2**20
+    args["peak_memory_mb"] = _peak_memory_mb()
+
+    # return only simulation parameter and no populations parameters
+    argsnew = {}
+    for key, value in args.items():
+        if type(value) in [int, bool, float, str]:
+            argsnew[key] = value
+    if headless:
+        if nrep is None:
+            day0 = int(day0)
+        return state, statesum, infections, day0, re, argsnew, None
+
+    allgroupresults = []
+    allresults = []
+    for k in reps:
+        agestats = _agestats(age, state[k] > 0, state[k] == 7,
+                             firstdayicu[k] < 1000)
+        groupresults, results = _groupresults(
+            agestats, statesum[k], infections[k], newicu[k], re[k],
+            rexternal[k], day0[k], day0date, pdf, alpha, realized)
+        if nrep is not None:
+            groupresults.insert(0, "Lauf", k[0])
+            results.insert(0, "Lauf", k[0])
+        allgroupresults.append(groupresults)
+        allresults.append(results)
+    results = pd.concat(allresults)
+    if sinks is None:
+        display(results)
+    groupresults = _write_results(
+        [ExcelSink(datadir)] if sinks is None else sinks, name, argsnew,
+        results, pd.concat(allgroupresults))
+    if sinks is None:
+        tanalyse = time.time()
+        print("Simulation time: " + str(tanalyse-tstart))
+        print("Peak memory (MB): " + str(args["peak_memory_mb"]) +
+              ", individual arrays (MB): " + str(args["workset_mb"]))
+    if nrep is None:
+        day0 = int(day0)
+    return state, statesum, infections, day0, re, argsnew, groupresults
+
+
+def sim_iter(age, drate, **kwargs):
+    """Simulate model day by day.
+
+    The parameters are the same as in sim without headless and sinks. No
+    result tables are built.
+
+    Yields
+    ------
+    day : dictionary with the results of one simulation day
+        day : simulation day
+        counts : count of each state (array of length 8)
+        infections : number of new infections
+        re : effective reproduction number
+        reported : expected number of new reported cases
+        newicu : number of new icu admissions
+        day0 : day0 or -1 if it is not reached yet
+        With nrep, the values have the replica as first axis.
+    """
+    yield from _simulate(age, drate, **kwargs)
+
+
+def _simulate(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
+              day0cumrep=20,
+              prob_icu=0.005, mean_days_to_icu=12, mean_time_to_death=17,
+              mean_duration_icu=10, immunt0=0.0, ifr=0.5,
+              long_term_death=False, hnr=None, com_attack_rate=0.6,
+              simname="test", datadir=".", realized=None, rep_delay=8.7,
+              alpha=0.2, r_change=None, day0date=datetime.date(2020, 3, 15),
+              engine="dense", lean=False, sampler="uniform", backend="numpy",
+              nrep=None, seed=None, rng=None, checkpoint_days=(), resume=None,
+              fork_day=None, stop_extinct=False):
+    """Simulate model and yield the results of each day (see sim)."""
+    if engine not in ("dense", "active", "calendar"):
+        raise ValueError("Unknown engine: " + str(engine))
+    if sampler not in ("uniform", "count"):
+        raise ValueError("Unknown sampler: " + str(sampler))
+    if backend not in ("numpy", "numba"):
+        raise ValueError("Unknown backend: " + str(backend))
+    if backend == "numba" and (engine != "dense" or sampler != "uniform"):
+        raise ValueError("backend numba requires engine dense and sampler "
+                         "uniform")
+    if nrep is not None and (engine != "dense" or sampler != "uniform" or
+                             backend != "numpy"):
+        raise ValueError("nrep requires engine dense, sampler uniform and "
+                         "backend numpy")
+    if seed is not None and rng is not None:
+        raise ValueError("Use either seed or rng")
+    if fork_day is not None and (nrep is not None or fork_day < 1):
+        raise ValueError("fork_day requires nrep None and fork_day > 0")
+    if stop_extinct and long_term_death:
+        raise ValueError("stop_extinct requires long_term_death False")
+
+    # dtypes of the individual arrays
+    if lean:
+        if nday > 30000:
+            raise ValueError("lean supports at most 30000 days")
+        statetype, daytype = "int8", "int16"
+    else:
+        statetype, daytype = "int", "int"
 
     # replace dates
     keylist = list(r_change.keys())
@@ -180,194 +494,498 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
         com_attack_rate[newkey] = com_attack_rate[key]
         del com_attack_rate[key]
 
+    # Replicas
+    if nrep is None:
+        lead = ()
+    else:
+        lead = (nrep,)
+    reps = list(np.ndindex(lead))
+
+    # Random streams, None uses the global numpy random state
+    if rng is not None:
+        if isinstance(rng, np.random.Generator):
+            rng = [rng]
+        if len(rng) != len(reps):
+            raise ValueError("rng needs one Generator per replica")
+        rngs = list(rng)
+    elif seed is not None:
+        if isinstance(seed, np.random.SeedSequence):
+            # spawn from a copy, the SeedSequence of the caller is unchanged
+            seed = np.random.SeedSequence(seed.entropy,
+                                          spawn_key=seed.spawn_key,
+                                          pool_size=seed.pool_size)
+        else:
+            seed = np.random.SeedSequence(seed)
+        rngs = [np.random.default_rng(x) for x in seed.spawn(len(reps))]
+    else:
+        rngs = None
+
     # Initialize r
     daymin = min(r_change.keys())
+    rkey = np.full(lead, daymin)
     r = r_change[daymin]
-    rmean = np.mean(r)
+    rmean = np.full(lead, np.mean(r))
 
     daymin = min(com_attack_rate.keys())
-    com_attack_now = com_attack_rate[daymin]
+    com_attack_now = np.full(lead, com_attack_rate[daymin])
 
     # Simulation name
     r0aux = np.mean(r)
     name = simname
 
     n = len(age)
-    state = np.zeros(shape=(n), dtype="int")
+    state = np.zeros(shape=lead + (n,), dtype=statetype)
     # set ni individuals to infected
     nimmun = int(immunt0*n)
-    state[np.random.choice(n, nimmun)] = 1
-    state[np.random.choice(n, 20)] = 2
+    for j, k in enumerate(reps):
+        gen = np.random if rngs is None else rngs[j]
+        state[k][gen.choice(n, nimmun)] = 1
+        state[k][gen.choice(n, 20)] = 2
 
     nstate = 8
-    statesum = np.zeros(shape=(nstate, nday))
-    statesum[:, 0] = np.bincount(state, minlength=nstate)
+    statesum = np.zeros(shape=lead + (nstate, nday))
+    statesum[..., 0] = _bincount_rows(state, nstate)
 
     # Precalculate profile infection
-    p = mean_serial**2/std_serial**2
-    b = std_serial**2/mean_serial
-    x = np.linspace(0, 28, num=29, dtype=("int"))
-    x = gamma.cdf(x, a=p, scale=b)
-    delay = x[1:29] - x[0:28]
+    delay = delay_kernel("gamma", (mean_serial, std_serial), 28)
     delay = np.ascontiguousarray(delay[::-1])
 
     # Precalculate time to icu
-    time_to_icu = np.random.poisson(lam=mean_days_to_icu, size=n)
-    time_to_death = np.random.poisson(lam=mean_time_to_death, size=n)
-
-    # individual prob icu
-    ind_prob_icu = drate/np.mean(drate) * prob_icu
+    time_to_icu = _draw(rngs, "poisson", state.shape,
+                        lam=mean_days_to_icu).astype(daytype, copy=False)
+    time_to_death = _draw(rngs, "poisson", state.shape,
+                          lam=mean_time_to_death).astype(daytype, copy=False)
 
     # Precalculate time to icu
-    time_on_icu = np.random.poisson(lam=mean_duration_icu, size=n)
-    rans = np.random.random(size=n)
-    go_to_icu = rans < ind_prob_icu
+    time_on_icu = _draw(rngs, "poisson", state.shape,
+                        lam=mean_duration_icu).astype(daytype, copy=False)
+
+    # individual prob icu
+    rans = _draw(rngs, "random", state.shape)
+    go_to_icu = rans < (drate/np.mean(drate) * prob_icu)
 
-    rans = np.random.random(size=n)
+    rans = _draw(rngs, "random", state.shape)
     go_dead = rans < (drate/np.mean(drate) * ifr)
+    if lean:
+        go_to_icu = _PackedBool(go_to_icu)
+        go_dead = _PackedBool(go_dead)
 
     # initialize arrays
-    infections = np.zeros(shape=nday)
-    rexternal = np.zeros(shape=nday)
-    newicu = np.zeros(shape=nday)
-    reported = np.zeros(shape=nday)
-    cuminfected = np.zeros(shape=nday)
-    infections[0] = np.sum(state == 2)
-    firstdayinfected = np.full(shape=n, fill_value=1000, dtype="int")
+    infections = np.zeros(shape=lead + (nday,))
+    rexternal = np.zeros(shape=lead + (nday,))
+    newicu = np.zeros(shape=lead + (nday,))
+    reported = np.zeros(shape=lead + (nday,))
+    cumreported = np.zeros(shape=lead)
+    infections[..., 0] = np.sum(state == 2, axis=-1)
+    firstdayinfected = np.full(shape=state.shape, fill_value=1000,
+                               dtype=daytype)
     firstdayinfected[state == 2] = 0
 
-    firstdayicu = np.full(shape=n, fill_value=1000, dtype="int")
+    firstdayicu = np.full(shape=state.shape, fill_value=1000, dtype=daytype)
 
-    day0 = -1
+    day0 = np.full(lead, -1)
     burn = True
 
-    re = np.zeros(shape=nday)
+    # State counts of the days after the stop of stop_extinct
+    extinct = None
+    stopday = -1
 
-    # Precalculate profile infection
-    p = rep_delay**2/1**2
-    b = 1**2/rep_delay
-    x = np.linspace(0, 48, num=49, dtype=("int"))
-    x = gamma.cdf(x, a=p, scale=b)
-    pdf = x[1:49] - x[0:48]
+    # Index of individuals which can still change their state
+    if engine == "active":
+        active = np.flatnonzero(state == 2)
+        active_last = _last_transition_day(
+            active, firstdayinfected, time_to_icu, time_to_death, time_on_icu,
+            go_to_icu, go_dead)
+
+    # Calendar with the future transitions of the infected individuals
+    if engine == "calendar":
+        calendar = _make_calendar(nday)
+        _schedule_infected(calendar, 0, np.flatnonzero(state == 2),
+                           time_to_icu, time_to_death, go_to_icu, go_dead)
+
+    if engine != "dense" or backend == "numba":
+        statecount = np.bincount(state, minlength=nstate)
+
+    # Susceptibles grouped by their individual r
+    if sampler == "count":
+        strata = _make_strata(r, state)
+
+    re = np.zeros(shape=lead + (nday,))
+
+    # Precalculate profile report
+    pdf = delay_kernel("gamma", (rep_delay, 1), 48)
 
     # Precalculate community attack
     if hnr is not None:
         nhnr = np.max(hnr)+1
-        firstdayhnr = np.full(shape=n, fill_value=1000, dtype="int")
-        p = mean_serial**2/std_serial**2
-        b = std_serial**2/mean_serial
-        x = np.linspace(0, 28, num=29, dtype=("int"))
-        x = gamma.cdf(x, a=p, scale=b)
-        rans = np.random.random(n)
-        x = np.diff(x)
+        if engine == "dense":
+            firstdayhnr = np.full(shape=lead + (nhnr,), fill_value=1000,
+                                  dtype=daytype)
+        else:
+            hhoffsets, hhmembers = household_index(hnr)
+            hhbuckets = [[] for day in range(nday)]
+            firstdayhnr = np.full(shape=nhnr, fill_value=1000, dtype=daytype)
+        rans = _draw(rngs, "random", state.shape)
+        x = delay_kernel("gamma", (mean_serial, std_serial), 28)
         x = x / np.sum(x)
         d = np.linspace(0, 27, num=28, dtype=("int"))
-        com_days_to_infection = np.random.choice(d, n, p=x)
-        ranscom = np.random.random(n)
+        com_days_to_infection = _draw(rngs, "choice", state.shape, d,
+                                      p=x).astype(daytype, copy=False)
+        ranscom = _draw(rngs, "random", state.shape)
+
+    # Memory of the individual arrays
+    workset = sum(x.nbytes for x in [
+        state, firstdayinfected, firstdayicu, time_to_icu, time_to_death,
+        time_on_icu, go_to_icu, go_dead])
+    if hnr is not None:
+        workset += sum(x.nbytes for x in [
+            firstdayhnr, com_days_to_infection, ranscom])
+        if engine != "dense":
+            workset += hhoffsets.nbytes + hhmembers.nbytes
+
+    # Continue from a checkpoint
+    start = 1
+    if resume is not None:
+        start, values = _load_checkpoint(resume, rngs)
+        if values["state"].shape != state.shape or\
+                len(values["infections"]) != len(infections):
+            raise ValueError("The checkpoint does not match the simulation")
+        state, statesum, firstdayinfected, firstdayicu = [values[x] for x in [
+            "state", "statesum", "firstdayinfected", "firstdayicu"]]
+        time_to_icu, time_to_death, time_on_icu, go_to_icu, go_dead = [
+            values[x] for x in ["time_to_icu", "time_to_death",
+                                "time_on_icu", "go_to_icu", "go_dead"]]
+        infections, rexternal, newicu, reported, re = [values[x] for x in [
+            "infections", "rexternal", "newicu", "reported", "re"]]
+        day0, rkey, com_attack_now = [values[x] for x in [
+            "day0", "rkey", "com_attack_now"]]
+        extinct, stopday = values.get("extinct"), values.get("stopday", -1)
+        cumreported = values.get("cumreported", np.sum(reported, axis=-1))
+        r, rmean = _replica_r(r_change, rkey, reps)
+        if engine == "active":
+            active, active_last = values["active"], values["active_last"]
+        if engine == "calendar":
+            calendar = values["calendar"]
+        if engine != "dense" or backend == "numba":
+            statecount = values["statecount"]
+        if sampler == "count":
+            strata = values["strata"]
+        if hnr is not None:
+            firstdayhnr, com_days_to_infection, ranscom = [
+                values[x] for x in ["firstdayhnr", "com_days_to_infection",
+                                    "ranscom"]]
+            if engine != "dense":
+                hhbuckets = values["hhbuckets"]
 
+    if start == 1:
+        yield _dayrecord(0, statesum, infections, re, reported, newicu, day0)
 
-    for i in range(1, nday):
+    for i in range(start, nday):
 
         # New infections on day i
         imin = max(0, i-28)
-        h = infections[imin: i]
-        newinf = np.sum(h*delay[-len(h):])
-
-        # unconditional deaths
-        if long_term_death:
-            rans = np.random.random(size=n)
-            state[(rans < drate) & (state != 7)] = 4
-
-        # Calculate the number of days infected
-        days_infected = i - firstdayinfected
-
-        # set all infected and identified case with more than 30 days to immun
-        state[((days_infected > 28) & (state < 4)) |
-              (time_on_icu == (i - firstdayicu))] = 1
-
-        # for infected cases calculate the probability of icu admission
-        filt = (time_to_icu == days_infected) & go_to_icu & (state == 2)
-        state[filt] = 6
-        firstdayicu[filt] = i
-        newicu[i] = np.sum(filt)
-
-        state[(time_to_death < days_infected) & go_dead] = 7
-
-        # The new infections are mapped to households
-        if hnr is not None:
-            # Household infections
-
-            filt2 = (com_days_to_infection == (i - firstdayhnr[hnr])) &\
-                (state == 0) & (ranscom < com_attack_now)
-            # external infections
-            aux = n / newinf
-            rans = np.random.random(size=n) * aux
-            filt1 = (rans < r) & (state == 0)
-
-            filt = filt1 | filt2
-            state[filt] = 2
-
-            # Store the new infections in each household
-            newhnr = hnr[filt1]
-            firstdayhnr[newhnr] = np.where(firstdayhnr[newhnr] < i,
-                                           firstdayhnr[newhnr], i)
+        h = infections[..., imin: i]
+        newinf = np.sum(h*delay[-h.shape[-1]:], axis=-1)
+
+        if extinct is not None:
+            # no infected individuals left, the counts are precomputed
+            statesum[..., i] = extinct[..., i]
+        elif backend == "numba":
+            # fused step with the same random numbers as the numpy backend
+            if long_term_death:
+                ransdeath = _draw(rngs, "random", state.shape)
+            else:
+                ransdeath = np.zeros(0)
+            rans = _draw(rngs, "random", state.shape)
+            if hnr is not None:
+                hhargs = (hnr, firstdayhnr, com_days_to_infection, ranscom,
+                          float(com_attack_now))
+            else:
+                hhargs = (np.zeros(0, dtype="int"), np.zeros(0, dtype="int"),
+                          np.zeros(0, dtype="int"), np.zeros(0), 0.0)
+            newicu[i], infections[i] = fused.daystep(
+                i, state, firstdayinfected, firstdayicu, time_to_icu,
+                time_to_death, time_on_icu, *_flagargs(go_to_icu, go_dead),
+                ransdeath, drate, rans, n / newinf, r, *hhargs, statecount)
+            statesum[:, i] = statecount
         else:
-            # infection probabilties by case
-            aux = n / newinf
-            rans = np.random.random(size=n) * aux
-            filt = (rans < r) & (state == 0)
-            state[filt] = 2
-
-        # store first infections day
-        firstdayinfected[filt] = i
-
-        rexternal[i] = rmean
-
-        # number of new infections
-        infections[i] = np.sum(filt)
-        if newinf > 0:
-            re[i] = infections[i] / newinf
-        else:
-            re[i] = 0
-
-        statesum[:, i] = np.bincount(state, minlength=nstate)
-
-        for s in range(0, min(i, 35)):
-            reported[i] = reported[i] + infections[i-s] * pdf[s] * alpha
+            # unconditional deaths
+            if long_term_death:
+                rans = _draw(rngs, "random", state.shape)
+                filt = (rans < drate) & (state != 7)
+                if sampler == "count":
+                    _strata_remove(strata,
+                                   np.flatnonzero(filt & (state == 0)))
+                if engine != "dense":
+                    statecount -= np.bincount(state[filt], minlength=nstate)
+                    statecount[4] += np.sum(filt)
+                state[filt] = 4
+
+            if engine == "active":
+                newicu[i] = _transitions_active(
+                    i, active, state, firstdayinfected, firstdayicu,
+                    time_to_icu, time_to_death, time_on_icu, go_to_icu,
+                    go_dead, statecount)
+            elif engine == "calendar":
+                newicu[i] = _transitions_calendar(
+                    i, calendar, state, firstdayicu, time_on_icu, statecount)
+            else:
+                # Calculate the number of days infected
+                days_infected = i - firstdayinfected
+
+                # set all infected and identified case with more than 30 days
+                # to immun
+                state[((days_infected > 28) & (state < 4)) |
+                      (time_on_icu == (i - firstdayicu))] = 1
+
+                # for infected cases calculate the probability of icu
+                # admission
+                filt = (time_to_icu == days_infected) & go_to_icu &\
+                    (state == 2)
+                state[filt] = 6
+                firstdayicu[filt] = i
+                newicu[..., i] = np.sum(filt, axis=-1)
+
+                state[(time_to_death < days_infected) & go_dead] = 7
+
+            # External infections, the dense engine works on masks of the
+            # infected individuals, the sparse engines on their indices
+            if sampler == "count":
+                external = _sample_infections(
+                    strata, r, state, newinf / n,
+                    np.random if rngs is None else rngs[0])
+                if engine == "dense":
+                    external = _index_mask(external, n)
+            else:
+                aux = n / newinf
+                rans = _draw(rngs, "random", state.shape)
+                rans *= aux[..., None]
+                external = (rans < r) & (state == 0)
+                if engine != "dense":
+                    external = np.flatnonzero(external)
+
+            # The new infections are mapped to households
+            if hnr is not None:
+                # Household infections
+                if engine == "dense":
+                    newinfected = (com_days_to_infection ==
+                                   (i - np.take(firstdayhnr, hnr, axis=-1))) &\
+                        (state == 0) & (ranscom < com_attack_now[..., None])
+                    newinfected |= external
+
+                    # Store the new infections in each household
+                    newhnr = np.nonzero(external)
+                    newhnr = newhnr[:-1] + (hnr[newhnr[-1]],)
+                    firstdayhnr[newhnr] = np.where(firstdayhnr[newhnr] < i,
+                                                   firstdayhnr[newhnr], i)
+                else:
+                    hhinfected = _calendar_pop(hhbuckets, i)
+                    hhinfected = hhinfected[
+                        (state[hhinfected] == 0) &
+                        (ranscom[hhinfected] < com_attack_now)]
+                    newinfected = np.union1d(external, hhinfected)
+
+                    # Schedule the members of new infected households
+                    _schedule_household(hhbuckets, i, external, hnr, hhoffsets,
+                                        hhmembers, firstdayhnr,
+                                        com_days_to_infection)
+            else:
+                newinfected = external
+            state[newinfected] = 2
+
+            # store first infections day
+            firstdayinfected[newinfected] = i
+
+            if sampler == "count":
+                _strata_remove(strata, newinfected)
+            if engine != "dense":
+                statecount[0] -= len(newinfected)
+                statecount[2] += len(newinfected)
+            if engine == "active":
+                keep = active_last > i
+                active = np.concatenate((active[keep], newinfected))
+                active_last = np.concatenate((
+                    active_last[keep],
+                    _last_transition_day(newinfected, firstdayinfected,
+                                         time_to_icu, time_to_death,
+                                         time_on_icu, go_to_icu, go_dead)))
+            elif engine == "calendar":
+                _schedule_infected(calendar, i, newinfected, time_to_icu,
+                                   time_to_death, go_to_icu, go_dead)
+
+            # number of new infections
+            if engine != "dense":
+                infections[i] = len(newinfected)
+                statesum[:, i] = statecount
+            else:
+                infections[..., i] = np.count_nonzero(newinfected, axis=-1)
+                statesum[..., i] = _bincount_rows(state, nstate)
+
+        rexternal[..., i] = rmean
+        re[..., i] = np.divide(infections[..., i], newinf, out=np.zeros(lead),
+                               where=newinf > 0)
+
+        reported[..., i] = delay_step(infections, pdf, i, window=35) * alpha
+        cumreported += reported[..., i]
 
         # find day0
-        if (np.sum(reported) > day0cumrep) and (day0 == -1):
-            day0 = i
+        day0 = np.where((cumreported > day0cumrep) & (day0 == -1), i, day0)
+
+        # adjust r and community attack rate of each replica
+        rnew = False
+        for k in reps:
+            if (day0[k] > -1) and ((i-day0[k]) in r_change.keys()):
+                rkey[k] = i-day0[k]
+                rnew = True
+            if (day0[k] > -1) and ((i-day0[k]) in com_attack_rate.keys()):
+                com_attack_now[k] = com_attack_rate[i-day0[k]]
+        if rnew:
+            r, rmean = _replica_r(r_change, rkey, reps)
+            if sampler == "count":
+                strata = _make_strata(r, state)
+
+        yield _dayrecord(i, statesum, infections, re, reported, newicu, day0)
+
+        # stop the simulation of the individuals without infections in the
+        # last 29 days, all infected individuals have recovered or died
+        if stop_extinct and extinct is None and i >= 28 and\
+                not np.any(infections[..., i-28:i+1]):
+            extinct = _extinct_statesum(i, state, statesum, firstdayinfected,
+                                        firstdayicu, time_to_death,
+                                        time_on_icu, go_dead)
+            stopday = i
+
+        # snapshot of the simulation
+        if i in checkpoint_days:
+            values = locals()
+            _save_checkpoint(os.path.join(datadir, name + "_" + str(i) +
+                                          ".ckpt"), i,
+                             {x: values[x] for x in _CHECKPOINT
+                              if x in values}, rngs)
+
+        # fork of a scenario tree on the day before the change point
+        if fork_day is not None and day0 > -1 and i - day0 == fork_day - 1:
+            values = locals()
+            _save_checkpoint(os.path.join(datadir, name + "_fork.ckpt"), i,
+                             {x: values[x] for x in _CHECKPOINT
+                              if x in values}, rngs)
+            break
+
+    return {"state": state, "statesum": statesum, "infections": infections,
+            "newicu": newicu, "re": re, "rexternal": rexternal,
+            "firstdayicu": firstdayicu, "day0": day0, "pdf": pdf,
+            "reps": reps, "workset": workset, "name": name,
+            "stopday": stopday}
+
+
+def _extinct_statesum(i, state, statesum, firstdayinfected, firstdayicu,
+                      time_to_death, time_on_icu, go_dead):
+    """Return the state counts of all days, if no infections follow day i.
+
+    Without infected individuals only the icu discharges (state 6 to 1) and
+    the Covid-19 deaths (to state 7) of former infected individuals remain.
+    Their days follow from the individual arrays as in the dense engine.
+    The counts of the days up to i are copied from statesum, state is set to
+    the state of the last day.
+    """
+    nday = statesum.shape[-1]
+    firstdayinfected = firstdayinfected.astype(int)
+    deathday = np.where(np.asarray(go_dead) & (state != 7) &
+                        (firstdayinfected < 1000),
+                        firstdayinfected + time_to_death + 1, nday)
+    dischargeday = np.where((state == 6) & (time_on_icu > 0),
+                            firstdayicu.astype(int) + time_on_icu, nday)
+    deathday = np.minimum(deathday, nday)
+    delta = np.zeros(statesum.shape[:-1] + (nday + 1,))
+
+    # discharges before the death
+    idx = np.nonzero(dischargeday < deathday)
+    np.add.at(delta, idx[:-1] + (6, dischargeday[idx]), -1)
+    np.add.at(delta, idx[:-1] + (1, dischargeday[idx]), 1)
+    state[idx] = 1
+
+    idx = np.nonzero(deathday < nday)
+    np.add.at(delta, idx[:-1] + (state[idx], deathday[idx]), -1)
+    np.add.at(delta, idx[:-1] + (7, deathday[idx]), 1)
+    state[idx] = 7
+
+    extinct = statesum.copy()
+    extinct[..., i+1:] = statesum[..., i:i+1] +\
+        np.cumsum(delta[..., i+1:nday], axis=-1)
+    return extinct
+
+
+def _dayrecord(i, statesum, infections, re, reported, newicu, day0):
+    """Return the results of day i."""
+    return {"day": i, "counts": statesum[..., i].copy(),
+            "infections": infections[..., i].copy()[()],
+            "re": re[..., i].copy()[()],
+            "reported": reported[..., i].copy()[()],
+            "newicu": newicu[..., i].copy()[()],
+            "day0": day0.copy()[()]}
+
+
+def _exhaust(days):
+    """Run the generator days to its end and return its return value."""
+    while True:
+        try:
+            next(days)
+        except StopIteration as stop:
+            return stop.value
+
+
+def _write_results(sinks, name, argsnew, results, groupresults):
+    """Write the parameters and the results of a simulation to the sinks.
 
-        # adjust r
-        if (day0 > -1) and ((i-day0) in r_change.keys()):
-            r = r_change[i-day0]
-            rmean = np.mean(r)
+    Returns
+    -------
+    groupresults : daily results from 2020-03-01 on
+    """
+    groupresults = groupresults[groupresults.Datum >=
+                                datetime.date(2020, 3, 1)]
+    if len(sinks) > 0:
+        params = pd.DataFrame.from_dict(argsnew, orient="index")
+        params = params.reset_index()
+        params.columns = ["Parameter", "Wert"]
+        for sink in sinks:
+            sink.write(name, params, results, groupresults)
+    return groupresults
 
-        # change community attack rate
-        if (day0 > -1) and ((i-day0) in com_attack_rate.keys()):
-            com_attack_now = com_attack_rate[i-day0]
 
+def _agestats(age, infected, dead, icu, counts=False):
+    """Return the mean and median age of the infected, dead and icu patients.
 
-    # return only simulation parameter and no populations parameters
-    argsnew = {}
-    for key, value in args.items():
-        if type(value) in [int, bool, float, str]:
-            argsnew[key] = value
-    params = pd.DataFrame.from_dict(argsnew, orient="index")
-    params = params.reset_index()
-    params.columns = ["Parameter", "Wert"]
-
-    agegroup = (age/10).astype(int)*10
+    infected, dead and icu are boolean masks of the individuals or, with
+    counts, the number of persons of each entry of age.
+    """
+    agestats = {}
+    for col, select in [('Erwartete Neu-Infektionen', infected),
+                        ("Erwartete neue Tote", dead),
+                        ("Erwartete Neu-Intensiv", icu)]:
+        if not counts:
+            agestats[col] = (np.mean(age[select]), np.median(age[select]))
+        elif np.sum(select) == 0:
+            agestats[col] = (np.nan, np.nan)
+        else:
+            order = np.argsort(age)
+            cum = np.cumsum(select[order])
+            median = age[order][np.searchsorted(cum, cum[-1] / 2)]
+            agestats[col] = (np.average(age, weights=select), median)
+    return agestats
 
-    # Write each dataframe to a different worksheet.
-    excelfile = os.path.join(datadir, name + ".xlsx")
-    writer = pd.ExcelWriter(excelfile, engine='xlsxwriter')
 
-    params.to_excel(writer, sheet_name="Parameter", index=False)
+def _groupresults(agestats, statesum, infections, newicu, re, rexternal,
+                  day0, day0date, pdf, alpha, realized):
+    """Calculate the daily results and the overview of one simulation run.
 
+    Returns
+    -------
+    groupresults : daily results as a dataframe
+    results : overview with peaks and sums as a dataframe
+    """
+    nday = len(infections)
     groupresults = pd.DataFrame({"Tag": [(x-day0) for x in range(0, nday)]})
-    groupresults["Datum"] = [day0date + datetime.timedelta(days=x-day0)
+    groupresults["Datum"] = [day0date + datetime.timedelta(days=int(x-day0))
                              for x in range(0, nday)]
     groupresults["neue Infektionen"] = infections
 
@@ -378,12 +996,7 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
     newinfections = np.diff(cuminfected, prepend=0)
 
     # reported
-    reported = np.empty_like(cuminfected)
-    reported[0] = 0
-    for t in range(1, len(newinfections)):
-        reported[t] = 0
-        for s in range(0, min(t, 27)):
-            reported[t] = reported[t] + newinfections[t-s] * pdf[s]
+    reported = delay_convolve(newinfections, pdf, window=27)
     groupresults["Meldefälle"] = np.around(reported * alpha)
     groupresults["Meldefälle (kum.)"] = groupresults["Meldefälle"].cumsum()
     groupresults["Erwartete Neu-Intensiv"] = newicu
@@ -423,7 +1036,6 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
     groupresults["Erwartete neue Tote"] = np.diff(groupresults["Erwartete Tote"],
                                                   prepend=0)
 
-    wasintensive = firstdayicu < 1000
     for col in ['Erwartete Neu-Infektionen', 'Erwartete Neu-Meldefälle',
                 'ICU', "Erwartete Neu-Intensiv", 'Erwartete neue Tote']:
         res = {}
@@ -431,48 +1043,437 @@ def sim(age, drate, mean_serial=7.0, std_serial=3.4, nday=140,
         res["Peaktag"] = np.array(groupresults.Datum)[peakd]
         res["Peakwert"] = np.array(groupresults[col])[peakd]
         res["Summe"] = np.sum(groupresults[col])
-        if col == 'Erwartete Neu-Infektionen':
-            res["Mittleres Alter"] = np.mean(age[state > 0])
-            res["Median Alter"] = np.median(age[state > 0])
-        if col == "Erwartete neue Tote":
-            res["Mittleres Alter"] = np.mean(age[state == 7])
-            res["Median Alter"] = np.median(age[state == 7])
-        if col == "Erwartete Neu-Intensiv":
-            res["Mittleres Alter"] = np.mean(age[wasintensive])
-            res["Median Alter"] = np.median(age[wasintensive])
+        if col in agestats:
+            res["Mittleres Alter"], res["Median Alter"] = agestats[col]
         results[col] = res
     results = pd.DataFrame.from_dict(results, orient="index")
-    display(results)
-    results.to_excel(writer, sheet_name='Ergebnisübersicht', index=False)
+    return groupresults, results
 
-    groupresults = groupresults[groupresults.Datum >=
-                                datetime.date(2020, 3, 1)]
-    groupresults.to_excel(writer, sheet_name='Zustand pro Tag', index=False)
 
-    writer.save()
-    tanalyse = time.time()
-    print("Simulation time: " + str(tanalyse-tstart))
-    return state, statesum, infections, day0, re, argsnew, groupresults
+class _PackedBool:
+    """Boolean array stored with one bit per individual.
+
+    Indexing with an index array returns the boolean values of these
+    individuals, numpy operations on the whole object unpack it.
+    """
+
+    def __init__(self, values):
+        self.shape = values.shape
+        self.n = values.shape[-1]
+        self.bits = np.packbits(values, axis=-1)
+        self.nbytes = self.bits.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        idx = np.asarray(idx)
+        return ((self.bits[idx >> 3] >> (7 - (idx & 7))) & 1).astype(bool)
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.unpackbits(self.bits, axis=-1, count=self.n).view(bool)
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+
+def _flagargs(go_to_icu, go_dead):
+    """Return the flag arrays for the fused kernel as uint8 arrays."""
+    if isinstance(go_to_icu, _PackedBool):
+        return go_to_icu.bits, go_dead.bits, True
+    return go_to_icu.view("uint8"), go_dead.view("uint8"), False
+
+
+def _replica_r(r_change, rkey, reps):
+    """Return the individual r and its mean at the change point of rkey."""
+    if np.all(rkey == rkey.flat[0]):
+        r = r_change[rkey.flat[0]]
+    else:
+        r = np.stack([r_change[rkey[k]] for k in reps])
+    rmean = np.mean(r, axis=-1) * np.ones(rkey.shape)
+    return r, rmean
+
+
+def _save_checkpoint(filename, i, values, rngs):
+    """Write the state of the simulation after day i to filename."""
+    if rngs is None:
+        rngstate = np.random.get_state()
+    else:
+        rngstate = [gen.bit_generator.state for gen in rngs]
+    with open(filename, "wb") as f:
+        pickle.dump({"day": i, "rngstate": rngstate, "values": values}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_checkpoint(filename, rngs):
+    """Read a checkpoint and restore the state of the random numbers.
+
+    Returns
+    -------
+    start : first day to simulate
+    values : dictionary with the state of the simulation
+    """
+    with open(filename, "rb") as f:
+        checkpoint = pickle.load(f)
+    rngstate = checkpoint["rngstate"]
+    if rngs is None:
+        if isinstance(rngstate, list):
+            raise ValueError("The checkpoint requires seed or rng")
+        np.random.set_state(rngstate)
+    else:
+        if not isinstance(rngstate, list) or len(rngstate) != len(rngs):
+            raise ValueError("The checkpoint does not match seed or rng")
+        for gen, genstate in zip(rngs, rngstate):
+            gen.bit_generator.state = genstate
+    return checkpoint["day"] + 1, checkpoint["values"]
+
+
+def _draw(rngs, method, shape, *args, **kwargs):
+    """Draw random numbers of the given shape with a method of Generator.
+
+    Each row along the last axis is drawn from its own stream of rngs, if
+    rngs is None the global numpy random state is used.
+    """
+    if rngs is None:
+        return getattr(np.random, method)(*args, size=shape, **kwargs)
+    if len(shape) == 1:
+        return getattr(rngs[0], method)(*args, size=shape, **kwargs)
+    values = [getattr(gen, method)(*args, size=shape[-1], **kwargs)
+              for gen in rngs]
+    return np.reshape(values, shape)
+
+
+def _index_mask(idx, n):
+    """Return a boolean mask of length n which is True at idx."""
+    mask = np.zeros(n, dtype=bool)
+    mask[idx] = True
+    return mask
+
+
+def _bincount_rows(state, nstate):
+    """Count the states along the last axis of state."""
+    if state.ndim == 1:
+        return np.bincount(state, minlength=nstate)
+    counts = [np.bincount(row, minlength=nstate)
+              for row in state.reshape(-1, state.shape[-1])]
+    return np.reshape(counts, state.shape[:-1] + (nstate,))
+
+
+def _peak_memory_mb():
+    """Return the peak resident memory of the process in MB."""
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 2**10
+
+
+def _last_transition_day(idx, firstdayinfected, time_to_icu, time_to_death,
+                         time_on_icu, go_to_icu, go_dead):
+    """Calculate the last day on which infected individuals change state.
+
+    After this day none of the transitions in sim (recovery, icu admission,
+    icu discharge, Covid-19 death) can apply to the individual anymore.
+    """
+    last = np.full(len(idx), 29)
+    last = np.maximum(last, np.where(go_dead[idx], time_to_death[idx] + 1, 0))
+    last = np.maximum(last, np.where(go_to_icu[idx],
+                                     time_to_icu[idx] + time_on_icu[idx], 0))
+    return firstdayinfected[idx] + last
+
+
+def _transitions_active(i, active, state, firstdayinfected, firstdayicu,
+                        time_to_icu, time_to_death, time_on_icu, go_to_icu,
+                        go_dead, statecount):
+    """Apply the daily transitions to the active individuals only.
+
+    Same rules as the dense evaluation in sim, restricted to the index of
+    individuals which are infected or on icu. The state counts are updated
+    in place.
+
+    Returns
+    -------
+    newicu : number of new icu admissions on day i
+    """
+    nstate = len(statecount)
+    days_infected = i - firstdayinfected[active]
+    st = state[active]
+    statecount -= np.bincount(st, minlength=nstate)
+
+    # recovery and icu discharge
+    st[((days_infected > 28) & (st < 4)) |
+       (time_on_icu[active] == (i - firstdayicu[active]))] = 1
+
+    # icu admission
+    filt = (time_to_icu[active] == days_infected) & go_to_icu[active] &\
+        (st == 2)
+    st[filt] = 6
+    firstdayicu[active[filt]] = i
+
+    # Covid-19 death
+    st[(time_to_death[active] < days_infected) & go_dead[active]] = 7
+
+    state[active] = st
+    statecount += np.bincount(st, minlength=nstate)
+    return np.sum(filt)
+
+
+def _make_calendar(nday):
+    """Create an empty event calendar for nday days.
+
+    The calendar has one entry per transition type. Each entry is a list
+    with one bucket per absolute simulation day, a bucket is a list of index
+    arrays of the individuals with an event on that day. Further pathways
+    (e.g. the hospital state) are added as further entries.
+    """
+    return {event: [[] for day in range(nday)]
+            for event in ["recovery", "icu", "discharge", "death"]}
+
+
+def _calendar_push(buckets, days, idx):
+    """Add the individuals idx with their event days to the buckets."""
+    filt = days < len(buckets)
+    days = days[filt]
+    idx = idx[filt]
+    if len(idx) == 0:
+        return
+    order = np.argsort(days, kind="stable")
+    days = days[order]
+    idx = idx[order]
+    uniq, start = np.unique(days, return_index=True)
+    for day, members in zip(uniq, np.split(idx, start[1:])):
+        buckets[day].append(members)
+
+
+def _calendar_pop(buckets, day):
+    """Remove and return the individuals with an event on day."""
+    members = buckets[day]
+    buckets[day] = []
+    if len(members) == 0:
+        return np.zeros(0, dtype="int")
+    return np.concatenate(members)
+
+
+def _schedule_infected(calendar, day, idx, time_to_icu, time_to_death,
+                       go_to_icu, go_dead):
+    """Schedule the transitions of the individuals infected on day."""
+    # recovery after 28 days
+    _calendar_push(calendar["recovery"], np.full(len(idx), day + 29), idx)
+
+    # icu admission (checked against the state on the day of admission)
+    icu = idx[go_to_icu[idx] & (time_to_icu[idx] > 0)]
+    _calendar_push(calendar["icu"], day + time_to_icu[icu], icu)
+
+    # Covid-19 death on the first day after time_to_death
+    dead = idx[go_dead[idx]]
+    _calendar_push(calendar["death"], day + time_to_death[dead] + 1, dead)
+
+
+def _transitions_calendar(i, calendar, state, firstdayicu, time_on_icu,
+                          statecount):
+    """Apply the transitions scheduled for day i.
+
+    The events are processed in the same order as the dense evaluation in
+    sim: recovery and icu discharge, icu admission, Covid-19 death. The
+    state counts are updated in place.
+
+    Returns
+    -------
+    newicu : number of new icu admissions on day i
+    """
+    # recovery of infected cases
+    idx = _calendar_pop(calendar["recovery"], i)
+    idx = idx[state[idx] < 4]
+    _setstate(state, idx, 1, statecount)
+
+    # icu discharge, the Covid-19 dead stay dead
+    idx = _calendar_pop(calendar["discharge"], i)
+    idx = idx[state[idx] != 7]
+    _setstate(state, idx, 1, statecount)
+
+    # icu admission
+    idx = _calendar_pop(calendar["icu"], i)
+    idx = idx[state[idx] == 2]
+    _setstate(state, idx, 6, statecount)
+    firstdayicu[idx] = i
+    newicu = len(idx)
+    dis = idx[time_on_icu[idx] > 0]
+    _calendar_push(calendar["discharge"], i + time_on_icu[dis], dis)
+
+    # Covid-19 death
+    idx = _calendar_pop(calendar["death"], i)
+    _setstate(state, idx, 7, statecount)
+    return newicu
+
+
+def _setstate(state, idx, newstate, statecount):
+    """Set the state of the individuals idx and update the state counts."""
+    statecount -= np.bincount(state[idx], minlength=len(statecount))
+    statecount[newstate] += len(idx)
+    state[idx] = newstate
+
+
+def _make_strata(r, state, nmax=1000):
+    """Group the susceptible individuals into strata of equal r.
+
+    If r has more than nmax different values, the individuals are grouped
+    into nmax quantile bins of r instead.
+
+    Returns
+    -------
+    strata : dictionary with
+        stratum : array of length n with the stratum of each individual
+        rmax : array with the maximum r of each stratum
+        exact : True if all individuals in a stratum have the same r
+        members : list with the index of the individuals of each stratum,
+            which are susceptible or were susceptible at the last compaction
+        nsus : array with the number of susceptibles in each stratum
+    """
+    values, stratum = np.unique(r, return_inverse=True)
+    exact = len(values) <= nmax
+    if not exact:
+        edges = np.unique(np.quantile(r, np.linspace(0, 1, nmax + 1)))
+        stratum = np.searchsorted(edges[1:-1], r, side="right")
+    nstrata = np.max(stratum) + 1
+    stratum = stratum.astype("int16" if nstrata < 2**15 else "int32")
+
+    idx = np.flatnonzero(state == 0)
+    if len(state) < 2**31:
+        idx = idx.astype("int32")
+    idx = idx[np.argsort(stratum[idx], kind="stable")]
+    nsus = np.bincount(stratum[idx], minlength=nstrata)
+    members = np.split(idx, np.cumsum(nsus)[:-1])
+    if exact:
+        rmax = values
+    else:
+        rmax = np.zeros(nstrata)
+        np.maximum.at(rmax, stratum, r)
+    return {"stratum": stratum, "rmax": rmax, "exact": exact,
+            "members": members, "nsus": nsus}
+
+
+def _strata_remove(strata, idx):
+    """Remove individuals which are not susceptible anymore."""
+    strata["nsus"] -= np.bincount(strata["stratum"][idx],
+                                  minlength=len(strata["nsus"]))
+
+
+def _sample_infections(strata, r, state, scale, rng):
+    """Sample the external infections of one day.
+
+    Each susceptible individual j is infected with probability
+    min(1, r[j]*scale). The number of candidates per stratum is binomial
+    with the maximal probability of the stratum, the candidates are drawn
+    uniformly from the susceptibles of the stratum and accepted with the
+    ratio of their probability to the maximal probability.
+
+    Returns
+    -------
+    idx : array with the index of the newly infected individuals
+    """
+    nsus = strata["nsus"]
+    pmax = np.minimum(strata["rmax"] * scale, 1)
+    ncand = rng.binomial(nsus, pmax)
+    infected = []
+    for k in np.flatnonzero(ncand):
+        cand = _sample_susceptible(strata, k, ncand[k], state, rng)
+        if not strata["exact"]:
+            p = np.minimum(r[cand] * scale, 1)
+            cand = cand[rng.random(size=len(cand)) * pmax[k] < p]
+        infected.append(cand)
+    if len(infected) == 0:
+        return np.zeros(0, dtype="int")
+    return np.concatenate(infected)
+
+
+def _sample_susceptible(strata, k, m, state, rng):
+    """Draw m different susceptible individuals of stratum k uniformly."""
+    members = strata["members"][k]
+    nsus = strata["nsus"][k]
+    if len(members) > 2 * nsus:
+        members = members[state[members] == 0]
+        strata["members"][k] = members
+    if 2 * m > nsus:
+        members = members[state[members] == 0]
+        return rng.choice(members, m, replace=False)
+
+    # rejection sampling, duplicates are removed in the order of the draws
+    chosen = members[:0]
+    while len(chosen) < m:
+        need = m - len(chosen)
+        pos = (rng.random(size=2 * need + 8) * len(members)).astype("int")
+        draw = members[pos]
+        draw = np.concatenate((chosen, draw[state[draw] == 0]))
+        uniq, first = np.unique(draw, return_index=True)
+        chosen = draw[np.sort(first)][:m]
+    return chosen
+
+
+def _schedule_household(buckets, i, external, hnr, offsets, members,
+                        firstdayhnr, com_days_to_infection):
+    """Schedule the household infections after external infections on day i.
+
+    Only households with their first external infection are considered. Each
+    member is a candidate for infection com_days_to_infection days later.
+    """
+    newhnr = np.unique(hnr[external])
+    newhnr = newhnr[firstdayhnr[newhnr] > i]
+    firstdayhnr[newhnr] = i
+    idx = members[_csr_positions(offsets, newhnr)]
+    days = com_days_to_infection[idx]
+    filt = days > 0
+    _calendar_push(buckets, i + days[filt], idx[filt])
+
+
+def _csr_positions(offsets, rows):
+    """Return the positions of all entries of rows in a compressed index."""
+    start = offsets[rows]
+    count = offsets[rows + 1] - start
+    shift = np.repeat(start - np.cumsum(count) + count, count)
+    return np.arange(np.sum(count)) + shift
+
+
+def household_index(hnr):
+    """Build a compressed household membership index.
+
+    Parameters
+    ----------
+    hnr : array of length n, household number of each individual
+
+    Returns
+    -------
+    offsets : array of length max(hnr)+2, the members of household h are
+        members[offsets[h]:offsets[h+1]]
+    members : array of length n with the individuals sorted by household
+    """
+    members = np.argsort(hnr, kind="stable")
+    if len(hnr) < 2**31:
+        members = members.astype("int32")
+    offsets = np.zeros(np.max(hnr) + 2, dtype="int64")
+    offsets[1:] = np.cumsum(np.bincount(hnr))
+    return offsets, members
 
 
 def read_campus(filename, n=1000000):
-    """Generate popupulation from campus."""
+    """Generate popupulation from campus.
+
+    The persons of campus are copied n // len(campus) times, the remaining
+    persons are whole households sampled from campus (see campus_counts).
+    Each copy of a household gets its own household number. The columns
+    are numpy arrays of exactly n persons.
+    """
     campus = pd.read_csv(filename)
-    nrep = int(np.around(n/campus.shape[0]))
-    repid = np.array([x for x in range(0, nrep)], dtype="int")
-    replica = np.tile(repid, campus.shape[0])
-    age = np.repeat(np.array(campus.age), nrep)
-    gender = np.repeat(np.array(campus.gender), nrep)
-    persons = np.repeat(np.array(campus.Personenzahl - 1), nrep)
-    contacts = np.repeat(np.array(campus.contacts_mean), nrep)
-    agegroup = np.repeat(np.array(campus.agegroup), nrep)
-    dr_year = np.repeat(np.array(campus.deathrate), nrep)
-    hnr = np.repeat(np.array(campus.hnrnew), nrep)
-    nhnr = np.max(hnr)+1
-    hnr = hnr + replica * nhnr
-
-    # normalize contacts to a mean of one
-    contacts = contacts / np.sum(contacts)*len(contacts)
+    counts = campus_counts(campus, n)
+    columns = _campus_columns(campus)
+    columns["contacts"] = _normalize_contacts(columns["contacts"], counts)
+    replica = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+    age, agegroup, gender, persons, contacts, dr_year, hnr = [
+        np.repeat(columns[x], counts) for x in
+        ["age", "agegroup", "gender", "persons", "contacts", "drate", "hnr"]]
+    hnr += replica * (np.max(columns["hnr"]) + 1)
 
     # Calculate daily mortality per case
     dr_day = 1 - (1-dr_year)**(1/365)
@@ -480,31 +1481,97 @@ def read_campus(filename, n=1000000):
     return age, agegroup, gender, contacts, dr_day, hnr, persons
 
 
+def campus_counts(campus, n):
+    """Return the number of copies of each person of campus for n persons.
+
+    All persons are copied n // len(campus) times. The remaining persons are
+    whole households drawn without replacement in a fixed random order, a
+    household which does not fit is skipped and only if no household fits,
+    the next household is truncated.
+
+    Returns
+    -------
+    counts : int array of length len(campus) with sum n
+    """
+    size = campus.shape[0]
+    counts = np.full(size, n // size, dtype="int64")
+    rest = n - (n // size) * size
+    if rest == 0:
+        return counts
+    offsets, members = household_index(np.asarray(campus.hnrnew))
+    sizes = np.diff(offsets)
+    order = np.random.default_rng(0).permutation(np.flatnonzero(sizes))
+    take = np.cumsum(sizes[order]) <= rest
+    rest -= np.sum(sizes[order[take]])
+    skipped = []
+    for j in np.flatnonzero(~take):
+        if rest == 0:
+            break
+        if sizes[order[j]] <= rest:
+            take[j] = True
+            rest -= sizes[order[j]]
+        else:
+            skipped.append(order[j])
+    chosen = [members[offsets[h]:offsets[h+1]] for h in order[take]]
+    if rest > 0:
+        chosen.append(members[offsets[skipped[0]]:offsets[skipped[0]]+rest])
+    counts[np.concatenate(chosen)] += 1
+    return counts
+
+
+def _normalize_contacts(contacts, counts):
+    """Normalize the contacts of groups to a mean of one over the persons.
+
+    counts is the number of persons of each group. The in-memory and the
+    stored populations use the same normalization, so their contacts are
+    identical.
+    """
+    contacts = np.asarray(contacts, dtype="float64")
+    return contacts / np.average(contacts, weights=counts)
+
+
+def _campus_columns(campus):
+    """Return the typed columns of the persons of campus."""
+    return {"age": np.asarray(campus.age, dtype="int16"),
+            "agegroup": np.asarray(campus.agegroup, dtype="int16"),
+            "gender": np.asarray(campus.gender).astype(str),
+            "persons": np.asarray(campus.Personenzahl - 1, dtype="int16"),
+            "contacts": np.asarray(campus.contacts_mean, dtype="float64"),
+            "drate": np.asarray(campus.deathrate, dtype="float64"),
+            "hnr": np.asarray(campus.hnrnew, dtype="int64")}
+
+
 def readpop(filename, n=1000000):
-    """Read population data."""
+    """Read population data.
+
+    The columns are numpy arrays of exactly n persons.
+    """
+    popi = readgroups(filename, n)
+    counts = np.asarray(popi.N1M)
+
+    # Generate individuals by repeating the groups
+    age = np.repeat(np.asarray(popi.age, dtype="int16"), counts)
+    agegroup = np.repeat(np.asarray(popi.agegroup, dtype="int16"), counts)
+    gender = np.repeat(np.asarray(popi.gender).astype(str), counts)
+    contacts = np.repeat(_normalize_contacts(popi.contacts_mean, counts),
+                         counts)
+    family = np.repeat(np.asarray(popi.family_factor, dtype="int16"), counts)
+
+    # Calculate daily mortality per group
+    dr = np.repeat(1 - (1-np.asarray(popi.deathrate))**(1/365), counts)
+
+    return age, agegroup, gender, family, contacts, dr
+
+
+def readgroups(filename, n=1000000):
+    """Read the population groups with their number of persons N1M."""
     popi = pd.read_csv(filename)
     popi["N1M"] = np.around(popi.portion * n).astype("int")
     dn = n - np.sum(popi["N1M"])
     nmax = np.argmax(popi.N1M)
     popi.iloc[nmax, popi.columns.get_loc('N1M')] = dn +\
         popi.iloc[nmax, popi.columns.get_loc('N1M')]
-    np.sum(popi["N1M"])
-
-    # Generate individuals by repeating the groups
-    age = np.repeat(popi.age, popi.N1M)
-    agegroup = np.repeat(popi.agegroup, popi.N1M)
-    gender = np.repeat(popi.gender, popi.N1M)
-    contacts = np.repeat(popi.contacts_mean, popi.N1M)
-    family = np.repeat(popi.family_factor, popi.N1M)
-
-    # normalize contacts to a mean of one
-    contacts = contacts / np.sum(contacts)*len(contacts)
-    dr = np.repeat(popi.deathrate, popi.N1M)
-
-    # Calculate daily mortality per case
-    dr = 1 - (1-dr)**(1/365)
-
-    return age, agegroup, gender, family, contacts, dr
+    return popi
 
 
 def analysestate(statesum, day0):
@@ -581,21 +1648,16 @@ def cfr_from_ts(date, cum_reported, cum_deaths, timetodeath, name):
     fig.add_traces(go.Scatter(x=date[imin:], y=crude[imin:], name="crude"))
     res = {}
     res["crude"] = crude[-1]
-    for timetodeath in [4, 8, 10]:
-        pdf = [scipy.stats.poisson.pmf(i, timetodeath) for i in range(0, 50)]
-        pdf = np.array(pdf)
-        corrected = np.empty_like(cum_reported)
-        corrected[0] = 0
-        newinfections = np.diff(cum_reported, prepend=0)
-        for t in range(1, len(newinfections)):
-            corrected[t] = 0
-            for s in range(0, min(t, 35)):
-                corrected[t] = corrected[t] + newinfections[t-s] * pdf[s]
-        corrected = np.cumsum(corrected)
-        corrected = cum_deaths / corrected
-        fig.add_traces(go.Scatter(x=date[imin:], y=corrected[imin:],
+    ttds = [4, 8, 10]
+    # expected reported of all delays at once, one row per delay
+    pdf = np.stack([delay_kernel("poisson", (t,), 50) for t in ttds])
+    newinfections = np.diff(cum_reported, prepend=0)
+    corrected = delay_convolve(newinfections, pdf, window=35)
+    corrected = cum_deaths / np.cumsum(corrected, axis=-1)
+    for timetodeath, row in zip(ttds, corrected):
+        fig.add_traces(go.Scatter(x=date[imin:], y=row[imin:],
                                   name=str(timetodeath)))
-        res["ttd="+str(timetodeath)] = corrected[-1]
+        res["ttd="+str(timetodeath)] = row[-1]
     fig.update_yaxes(title_text="CFR estimate", tickformat='.2%')
     plot(fig, filename="../figures/cfr_analysis/" + str(name) + ".html")
     return res
@@ -620,14 +1682,8 @@ def analyse_cfr(statesum, reffektive, delay, darkrate, cfr, timetodeath, name,
     newinfections = np.diff(cuminfected, prepend=0)
 
     # reported
-    pdf = [scipy.stats.poisson.pmf(i, 8) for i in range(0, 500)]
-    pdf = np.array(pdf)
-    reported = np.empty_like(cuminfected)
-    reported[0] = 0
-    for t in range(1, len(newinfections)):
-        reported[t] = 0
-        for s in range(0, min(t, 35)):
-            reported[t] = reported[t] + newinfections[t-s] * pdf[s]
+    pdf = delay_kernel("poisson", (8,), 500)
+    reported = delay_convolve(newinfections, pdf, window=35)
 
     # Constant line
     cfr_real = cfr * np.ones(shape=len(reported))
@@ -639,14 +1695,8 @@ def analyse_cfr(statesum, reffektive, delay, darkrate, cfr, timetodeath, name,
     corrected = statesum[7] / corrected
 
     # corrected
-    pdf = [scipy.stats.poisson.pmf(i, timetodeath) for i in range(0, 500)]
-    pdf = np.array(pdf)
-    corrected2 = np.empty_like(cuminfected)
-    corrected2[0] = 0
-    for t in range(1, len(newinfections)):
-        corrected2[t] = 0
-        for s in range(0, min(t, 35)):
-            corrected2[t] = corrected2[t] + newinfections[t-s] * pdf[s]
+    pdf = delay_kernel("poisson", (timetodeath,), 500)
+    corrected2 = delay_convolve(newinfections, pdf, window=35)
     corrected2 = np.cumsum(corrected2)
     corrected2 = statesum[7] / corrected2
 
@@ -751,4 +1801,3 @@ def plotoverview(gr, args):
     return
 
 
-
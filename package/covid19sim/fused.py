@@ -0,0 +1,121 @@
+"""Fused daily step kernel for sim.
+
+The kernel performs the daily update of the dense engine (long term deaths,
+recovery, icu admission and discharge, Covid-19 death, external and household
+infections and the state counts) in one pass over the individuals. It is
+compiled with numba, the random numbers are drawn by the caller so that the
+results are identical to the numpy backend.
+"""
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _jit(func):
+    """Compile func with numba if available."""
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+@_jit
+def _flag(flags, j, packed):
+    """Return the flag of individual j from a boolean or bit-packed array."""
+    if packed:
+        return ((flags[j >> 3] >> (7 - (j & 7))) & 1) == 1
+    return flags[j] != 0
+
+
+@_jit
+def _daystep(i, state, firstdayinfected, firstdayicu, time_to_icu,
+             time_to_death, time_on_icu, go_to_icu, go_dead, packed,
+             ransdeath, drate, rans, aux, r, hnr, firstdayhnr,
+             com_days_to_infection, ranscom, com_attack_now, statecount):
+    longterm = len(ransdeath) > 0
+    household = len(hnr) > 0
+    newicu = 0
+    newinfected = 0
+    statecount[:] = 0
+    for j in range(len(state)):
+        s = state[j]
+
+        # unconditional deaths
+        if longterm and ransdeath[j] < drate[j] and s != 7:
+            s = 4
+
+        # recovery and icu discharge
+        days_infected = i - firstdayinfected[j]
+        if (days_infected > 28 and s < 4) or\
+                time_on_icu[j] == i - firstdayicu[j]:
+            s = 1
+
+        # icu admission
+        if time_to_icu[j] == days_infected and s == 2 and\
+                _flag(go_to_icu, j, packed):
+            s = 6
+            firstdayicu[j] = i
+            newicu += 1
+
+        # Covid-19 death
+        if time_to_death[j] < days_infected and _flag(go_dead, j, packed):
+            s = 7
+
+        # external and household infections
+        if s == 0:
+            external = rans[j] * aux < r[j]
+            infected = external
+            if household:
+                h = hnr[j]
+                first = firstdayhnr[h]
+                if first < i and com_days_to_infection[j] == i - first and\
+                        ranscom[j] < com_attack_now:
+                    infected = True
+                if external and first > i:
+                    firstdayhnr[h] = i
+            if infected:
+                s = 2
+                firstdayinfected[j] = i
+                newinfected += 1
+
+        state[j] = s
+        statecount[s] += 1
+    return newicu, newinfected
+
+
+def daystep(i, state, firstdayinfected, firstdayicu, time_to_icu,
+            time_to_death, time_on_icu, go_to_icu, go_dead, packed,
+            ransdeath, drate, rans, aux, r, hnr, firstdayhnr,
+            com_days_to_infection, ranscom, com_attack_now, statecount):
+    """Perform the daily update of all individuals in one pass.
+
+    Parameters
+    ----------
+    i : simulation day
+    state, firstdayinfected, firstdayicu : individual arrays of sim, updated
+        in place
+    time_to_icu, time_to_death, time_on_icu : individual waiting times
+    go_to_icu, go_dead : uint8 arrays with the flags, bit-packed if packed
+    packed : Flag for bit-packed go_to_icu and go_dead
+    ransdeath : random numbers for the long term deaths, empty if not used
+    drate : daily mortality rate of each individual
+    rans : random numbers for the external infections
+    aux : scaling factor of the random numbers (n / expected infections)
+    r : individual r
+    hnr, firstdayhnr, com_days_to_infection, ranscom : household arrays of
+        sim, empty if no households are simulated
+    com_attack_now : current community attack rate
+    statecount : array of length 8, set to the state counts after the day
+
+    Returns
+    -------
+    newicu : number of new icu admissions
+    newinfected : number of new infections
+    """
+    if numba is None:
+        raise ImportError("The numba backend requires the numba package")
+    return _daystep(i, state, firstdayinfected, firstdayicu, time_to_icu,
+                    time_to_death, time_on_icu, go_to_icu, go_dead, packed,
+                    ransdeath, drate, rans, aux, r, hnr, firstdayhnr,
+                    com_days_to_infection, ranscom, com_attack_now,
+                    statecount)
@@ -0,0 +1,192 @@
+"""Parallel simulation of scenario grids."""
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from covid19sim import coronalib
+
+# Population of the worker process, set once by _init_worker
+_population = None
+
+
+def scenario_grid(**values):
+    """Return the scenarios of all combinations of the given values.
+
+    Parameters
+    ----------
+    values : keyword arguments of sim with a list of values each
+
+    Returns
+    -------
+    grid : list of dictionaries with the keyword arguments of each scenario
+    """
+    keys = list(values.keys())
+    return [dict(zip(keys, combination))
+            for combination in itertools.product(*values.values())]
+
+
+def sweep(grid, population, workers=None, seed=None, sinks=()):
+    """Simulate all scenarios of a grid in a process pool.
+
+    The population is sent once to each worker process and shared by all
+    scenarios simulated in this process.
+
+    Parameters
+    ----------
+    grid : list of dictionaries with the keyword arguments of sim for each
+        scenario. The values of r_change may be numbers, these are scaled
+        with the normalised contacts of the population.
+    population : dictionary or SharedPopulation with the arrays "age",
+        "drate" and optionally "contacts" and "hnr" (households are simulated
+        if hnr is given). A SharedPopulation is attached by the workers
+        without copying the arrays.
+    workers : number of worker processes, default is the number of cpus
+    seed : seed of the random numbers, each scenario gets its own stream
+    sinks : sinks writing the result tables of each scenario in the worker
+        processes (e.g. ExcelSink or CSVSink of covid19sim.sinks), by
+        default the results are only collected
+
+    Returns
+    -------
+    results : daily results of all scenarios as a dataframe with the
+        additional column "Szenario" (position in the grid) and the numeric
+        and text parameters of each scenario
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    seeds = np.random.SeedSequence(seed).spawn(len(grid))
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(population,)) as pool:
+        futures = [pool.submit(_run_scenario, k, scenario, seeds[k],
+                               list(sinks))
+                   for k, scenario in enumerate(grid)]
+        frames = [future.result() for future in futures]
+
+    return _collect(grid, frames)
+
+
+class SharedPopulation:
+    """Population arrays in shared memory.
+
+    The arrays are copied once into shared memory blocks. Pickling the
+    object only transfers the names of the blocks, the receiving process
+    attaches read-only views of the arrays without copying them. The
+    process which created the object removes the blocks with close.
+
+    Parameters
+    ----------
+    population : dictionary with the arrays of the population, e.g. "age",
+        "drate", "contacts", "hnr" and "persons" (None values are skipped)
+    """
+
+    def __init__(self, population):
+        self._owner = True
+        self._blocks = {}
+        self._arrays = {}
+        for key, values in population.items():
+            if values is None:
+                continue
+            values = np.asarray(values)
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(values.nbytes, 1))
+            array = np.ndarray(values.shape, dtype=values.dtype,
+                               buffer=block.buf)
+            array[...] = values
+            array.setflags(write=False)
+            self._blocks[key] = block
+            self._arrays[key] = array
+
+    @classmethod
+    def _attach(cls, spec):
+        """Attach to the shared memory blocks described by spec."""
+        self = cls.__new__(cls)
+        self._owner = False
+        self._blocks = {}
+        self._arrays = {}
+        for key, (name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=name)
+            array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            array.setflags(write=False)
+            self._blocks[key] = block
+            self._arrays[key] = array
+        return self
+
+    def __reduce__(self):
+        spec = {key: (self._blocks[key].name, array.shape, array.dtype.str)
+                for key, array in self._arrays.items()}
+        return (SharedPopulation._attach, (spec,))
+
+    def __getitem__(self, key):
+        return self._arrays[key]
+
+    def __contains__(self, key):
+        return key in self._arrays
+
+    def keys(self):
+        """Return the names of the arrays."""
+        return self._arrays.keys()
+
+    @property
+    def nbytes(self):
+        """Size of all arrays in bytes."""
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def close(self):
+        """Release the arrays, the creating process also removes them."""
+        self._arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _collect(grid, frames):
+    """Concatenate the daily results of the scenarios of a grid."""
+    for k, (scenario, frame) in enumerate(zip(grid, frames)):
+        frame.insert(0, "Szenario", k)
+        for key, value in scenario.items():
+            if type(value) in [int, bool, float, str]:
+                frame[key] = value
+    return pd.concat(frames, ignore_index=True)
+
+
+def _init_worker(population):
+    """Store the population in the worker process."""
+    global _population
+    _population = population
+
+
+def _run_scenario(k, scenario, seed, sinks):
+    """Simulate scenario k with the population of the worker process."""
+    kwargs = dict(scenario)
+    kwargs.setdefault("seed", seed)
+    kwargs.setdefault("simname", "Szenario " + str(k))
+    kwargs.setdefault("sinks", sinks)
+    kwargs["r_change"] = _scale_r(kwargs["r_change"], _population)
+    if "com_attack_rate" in kwargs:
+        kwargs["com_attack_rate"] = dict(kwargs["com_attack_rate"])
+    if "hnr" in _population:
+        kwargs.setdefault("hnr", _population["hnr"])
+    out = coronalib.sim(_population["age"], _population["drate"], **kwargs)
+    return out[6].reset_index(drop=True)
+
+
+def _scale_r(r_change, population):
+    """Scale numeric r's with the normalised contacts of the population."""
+    r_change = dict(r_change)
+    for key, r in r_change.items():
+        if np.ndim(r) == 0:
+            contacts = np.asarray(population["contacts"])
+            r_change[key] = r * contacts / np.mean(contacts)
+    return r_change
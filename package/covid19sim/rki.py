@@ -0,0 +1,618 @@
+"""Reading of the case data of the RKI (RKI_COVID19.csv).
+
+The csv file is parsed once into typed columns:
+
+Meldetag, Reftag : int32 day numbers (days since 1970-01-01)
+Meldedatum, Refdatum : the same days as datetime64
+KW : int8 iso calendar week of Meldedatum
+Bundesland, Landkreis, Altersgruppe, ... : categorical
+AnzahlFall, AnzahlTodesfall, ... : int32
+
+The columns are kept in a cache directory as .npy files (categorical
+columns as codes and categories), the cache of a file is replaced when the
+hash of the file changes.
+
+The daily cases and deaths of Germany, the Bundesländer and the Landkreise
+are aggregated in one pass over the integer codes of the regions and days
+(region_cube, aggregate_regions).
+
+The regional series and the cases and deaths of the age groups by calendar
+week can be kept in a store directory, which is built once from a
+publication (build_store) and updated with the changes of each following
+publication (update_store). The series are partitioned by month and the
+age groups by calendar week, an update only rewrites the partitions of the
+changed weeks and of the months from the first changed day on.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Columns with dates and the columns with their day numbers
+_DATES = {"Meldedatum": "Meldetag", "Refdatum": "Reftag"}
+
+# Text columns stored as categoricals
+_CATEGORIES = ["Bundesland", "Landkreis", "Altersgruppe", "Geschlecht",
+               "Altersgruppe2", "Datenstand"]
+
+# Integer columns and their dtypes
+_INTEGERS = {"IdBundesland": "int8", "IdLandkreis": "int32",
+             "AnzahlFall": "int32", "AnzahlTodesfall": "int32",
+             "NeuerFall": "int8", "NeuerTodesfall": "int8",
+             "NeuGenesen": "int8", "AnzahlGenesen": "int32",
+             "IstErkrankungsbeginn": "int8", "FID": "int64",
+             "ObjectId": "int64"}
+
+# Levels of the regions
+LEVELS = ("Land", "Bundesland", "Landkreis")
+
+
+def load_rki(filename, cache=None):
+    """Read RKI_COVID19.csv into typed columns.
+
+    Parameters
+    ----------
+    filename : path of RKI_COVID19.csv
+    cache : directory of the column cache, None reads the csv file without
+        cache
+
+    Returns
+    -------
+    rki : dataframe with the typed columns (see module description)
+    """
+    if cache is None:
+        return parse_rki(filename)
+    key = _file_hash(filename, cache)
+    base = os.path.splitext(os.path.basename(filename))[0]
+    directory = os.path.join(cache, base + "_" + key)
+    if not os.path.exists(os.path.join(directory, "complete")):
+        rki = parse_rki(filename)
+        # remove the caches of older versions of the file
+        for name in os.listdir(cache):
+            if name.startswith(base + "_") and\
+                    len(name) == len(base) + 17 and\
+                    os.path.isdir(os.path.join(cache, name)):
+                shutil.rmtree(os.path.join(cache, name), ignore_errors=True)
+        save_columns(directory, rki)
+        return rki
+    return load_columns(directory)
+
+
+def parse_rki(filename):
+    """Parse RKI_COVID19.csv into typed columns (see load_rki)."""
+    dtype = {col: "category" for col in _CATEGORIES}
+    dtype.update({col: "str" for col in _DATES})
+    rki = pd.read_csv(filename, dtype=dtype)
+    for col, daycol in _DATES.items():
+        if col in rki:
+            rki[daycol] = parse_days(rki[col])
+            rki[col] = day_dates(rki[daycol])
+    for col, coltype in _INTEGERS.items():
+        if col in rki:
+            rki[col] = rki[col].astype(coltype)
+    if "Meldetag" in rki:
+        rki["KW"] = iso_week(rki["Meldetag"])
+    return rki
+
+
+def parse_days(dates):
+    """Return the day numbers of date strings.
+
+    The strings start with the date as YYYY/MM/DD or YYYY-MM-DD, each
+    distinct string is parsed once.
+    """
+    codes, uniques = pd.factorize(dates)
+    days = np.array([x[:10].replace("/", "-") for x in uniques],
+                    dtype="datetime64[D]").astype("int32")
+    return days[codes]
+
+
+def day_dates(days):
+    """Return the dates (datetime64) of day numbers."""
+    return np.asarray(days, dtype="int64").astype("datetime64[D]").astype(
+        "datetime64[ns]")
+
+
+def iso_week(days):
+    """Return the iso calendar weeks (int8) of day numbers."""
+    days = np.asarray(days)
+    first = np.min(days)
+    weeks = pd.DatetimeIndex(day_dates(np.arange(first, np.max(days) + 1)))
+    weeks = np.asarray(weeks.isocalendar().week, dtype="int8")
+    return weeks[days - first]
+
+
+def region_cube(rki, levels=LEVELS, country="Deutschland"):
+    """Aggregate the daily cases and deaths of all regions.
+
+    The cases and deaths are summed in one pass over the codes of the pairs
+    of Bundesland and Landkreis and the days, the Landkreise are added up to
+    the Bundesländer and the country.
+
+    Parameters
+    ----------
+    rki : dataframe of load_rki
+    levels : levels of the regions, subset of LEVELS
+    country : name of the region of level "Land"
+
+    Returns
+    -------
+    cube : dictionary with "first" (day number of the first day), "Ebene"
+        and "Region" (level and name of each region) and "Fälle" and "Tote"
+        (arrays of shape (nregion, nday) with the daily cases and deaths by
+        date of report)
+    """
+    for level in levels:
+        if level not in LEVELS:
+            raise ValueError("Unknown level: " + str(level))
+    days = np.asarray(rki["Meldetag"], dtype="int64")
+    first = int(np.min(days))
+    nday = int(np.max(days)) - first + 1
+    blcodes, blnames = _codes(rki["Bundesland"])
+    lkcodes, lknames = _codes(rki["Landkreis"])
+    # missing regions get the code len(names) and are only counted in the
+    # regions of the levels above
+    blcodes = np.where(blcodes < 0, len(blnames), blcodes)
+    lkcodes = np.where(lkcodes < 0, len(lknames), lkcodes)
+    stride = len(lknames) + 1
+    pair, pairs = pd.factorize(blcodes * stride + lkcodes)
+    key = pair * nday + days - first
+    size = len(pairs) * nday
+    values = {}
+    for col, source in [("Fälle", "AnzahlFall"), ("Tote", "AnzahlTodesfall")]:
+        values[col] = np.rint(np.bincount(
+            key, weights=rki[source], minlength=size)).astype(
+                "int64").reshape(len(pairs), nday)
+
+    cube = {"first": first, "Ebene": [], "Region": [], "Fälle": [],
+            "Tote": []}
+    for level in levels:
+        if level == "Land":
+            codes = np.zeros(len(pairs), dtype="int64")
+            names = np.array([country])
+        elif level == "Bundesland":
+            codes = pairs // stride
+            names = blnames
+        else:
+            codes = pairs % stride
+            names = lknames
+        known = codes < len(names)
+        present = np.unique(codes[known])
+        index = np.searchsorted(present, codes[known])
+        for col in ["Fälle", "Tote"]:
+            sums = np.zeros((len(present), nday), dtype="int64")
+            np.add.at(sums, index, values[col][known])
+            cube[col].append(sums)
+        cube["Ebene"].append(np.repeat(level, len(present)))
+        cube["Region"].append(np.asarray(names, dtype=str)[present])
+    for col in ["Ebene", "Region", "Fälle", "Tote"]:
+        cube[col] = np.concatenate(cube[col])
+    return cube
+
+
+def cube_frame(cube):
+    """Return a cube of region_cube as dataframe.
+
+    The dataframe has a row for each region and day with the columns
+    Meldedatum, Tote, Fälle, Fälle_kum, Tote_kum, Region and Ebene. The
+    cumulated values are taken from "Fälle_kum" and "Tote_kum" of the cube
+    if given.
+    """
+    nregion, nday = cube["Fälle"].shape
+    cumulated = {}
+    for col in ["Fälle", "Tote"]:
+        cumulated[col] = cube.get(col + "_kum")
+        if cumulated[col] is None:
+            cumulated[col] = np.cumsum(cube[col], axis=1)
+    return pd.DataFrame({
+        "Meldedatum": np.tile(day_dates(cube["first"] + np.arange(nday)),
+                              nregion),
+        "Tote": cube["Tote"].ravel(),
+        "Fälle": cube["Fälle"].ravel(),
+        "Fälle_kum": cumulated["Fälle"].ravel(),
+        "Tote_kum": cumulated["Tote"].ravel(),
+        "Region": np.repeat(cube["Region"], nday),
+        "Ebene": np.repeat(cube["Ebene"], nday)})
+
+
+def aggregate_regions(rki, levels=LEVELS, country="Deutschland"):
+    """Return the daily and cumulated cases and deaths of all regions.
+
+    Each region has a row for every day from the first to the last date of
+    report in rki (see region_cube and cube_frame).
+    """
+    return cube_frame(region_cube(rki, levels=levels, country=country))
+
+
+def age_pivot(rki):
+    """Aggregate the cases and deaths of the age groups by calendar week.
+
+    Parameters
+    ----------
+    rki : dataframe of load_rki
+
+    Returns
+    -------
+    pivot : dictionary with "Altersgruppe" (names of the age groups), "KW"
+        (calendar weeks) and "Fälle" and "Tote" (arrays of shape (nage,
+        nweek))
+    """
+    agecodes, agenames = _codes(rki["Altersgruppe"])
+    # rows without age group are not counted
+    known = agecodes >= 0
+    agecodes = agecodes[known]
+    weeks, weekcodes = np.unique(np.asarray(rki["KW"])[known],
+                                 return_inverse=True)
+    present = np.unique(agecodes)
+    key = np.searchsorted(present, agecodes) * len(weeks) + weekcodes
+    pivot = {"Altersgruppe": np.asarray(agenames, dtype=str)[present],
+             "KW": weeks.astype("int64")}
+    for col, source in [("Fälle", "AnzahlFall"), ("Tote", "AnzahlTodesfall")]:
+        pivot[col] = np.rint(np.bincount(
+            key, weights=np.asarray(rki[source])[known],
+            minlength=len(present) * len(weeks))).astype("int64").reshape(
+                len(present), len(weeks))
+    return pivot
+
+
+def store_exists(directory):
+    """Return True if directory contains a store of build_store."""
+    return os.path.exists(os.path.join(directory, "meta.json"))
+
+
+def build_store(directory, rki):
+    """Build the store of the regional series and the age groups.
+
+    The cases and deaths of the publication are counted as described by the
+    RKI: rows with NeuerFall -1 (NeuerTodesfall -1) only belong to the
+    previous publication and are not counted. An existing store is replaced.
+
+    Parameters
+    ----------
+    directory : directory of the store
+    rki : dataframe of load_rki with a complete publication
+    """
+    counts = _publication_counts(rki, delta=False)
+    cube = region_cube(counts)
+    pivot = age_pivot(counts)
+    nday = cube["Fälle"].shape[1]
+    meta = {"first": cube["first"], "nday": nday,
+            "Ebene": cube["Ebene"].tolist(),
+            "Region": cube["Region"].tolist(),
+            "Altersgruppe": pivot["Altersgruppe"].tolist(),
+            "KW": pivot["KW"].tolist(),
+            "Datenstand": _datenstand(rki)}
+
+    tmpdir = directory + ".tmp" + str(os.getpid())
+    os.makedirs(tmpdir, exist_ok=True)
+    daily = np.stack([cube["Fälle"], cube["Tote"]])
+    _write_months(tmpdir, meta, daily, 0, np.zeros(daily.shape[:2],
+                                                   dtype="int64"))
+    for k, week in enumerate(meta["KW"]):
+        _save(os.path.join(tmpdir, "kw_" + str(week) + ".npy"),
+              np.stack([pivot["Fälle"][:, k], pivot["Tote"][:, k]]))
+    _save_meta(tmpdir, meta)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmpdir, directory)
+
+
+def update_store(directory, delta):
+    """Update the store with the changes of a new publication.
+
+    Parameters
+    ----------
+    directory : directory of the store (see build_store)
+    delta : dataframe of load_rki with the rows of the new publication with
+        NeuerFall or NeuerTodesfall -1 or 1 (all rows are counted as new
+        cases if the column NeuerFall is missing)
+
+    Returns
+    -------
+    updated : False if the publication (Datenstand) of delta is already
+        contained in the store, else True
+    """
+    meta = _load_meta(directory)
+    datenstand = _datenstand(delta)
+    if datenstand and all(x in meta["Datenstand"] for x in datenstand):
+        return False
+    counts = _publication_counts(delta, delta=True)
+    if len(counts) > 0:
+        _update_regions(directory, meta, region_cube(counts))
+        _update_weeks(directory, meta, age_pivot(counts))
+    meta["Datenstand"] += [x for x in datenstand
+                           if x not in meta["Datenstand"]]
+    _save_meta(directory, meta)
+    return True
+
+
+def load_cube(directory):
+    """Read the regional series of a store as cube (see region_cube).
+
+    The cube contains the stored cumulated values "Fälle_kum" and
+    "Tote_kum" in addition.
+    """
+    meta = _load_meta(directory)
+    labels, _ = _months(meta["first"], meta["nday"])
+    values = np.concatenate([np.load(_month_file(directory, label))
+                             for label in labels], axis=2)
+    return {"first": meta["first"], "Ebene": np.array(meta["Ebene"]),
+            "Region": np.array(meta["Region"]), "Fälle": values[0],
+            "Tote": values[1], "Fälle_kum": values[2],
+            "Tote_kum": values[3]}
+
+
+def load_pivots(directory):
+    """Read the age groups by calendar week of a store.
+
+    Returns
+    -------
+    pivots : dictionary with the dataframes "Fälle" and "Tote" with the age
+        groups as index and the calendar weeks as columns
+    """
+    meta = _load_meta(directory)
+    values = np.stack([np.load(os.path.join(directory,
+                                            "kw_" + str(week) + ".npy"))
+                       for week in meta["KW"]], axis=2)
+    index = pd.Index(meta["Altersgruppe"], name="Altersgruppe")
+    columns = pd.Index(meta["KW"], name="KW")
+    return {col: pd.DataFrame(values[k], index=index, columns=columns)
+            for k, col in enumerate(["Fälle", "Tote"])}
+
+
+def _publication_counts(rki, delta):
+    """Return the counted cases and deaths of a publication or its delta.
+
+    The cases of a publication are the rows with NeuerFall 0 or 1, the
+    changes to the previous publication the rows with NeuerFall -1 or 1
+    (the same with NeuerTodesfall for the deaths).
+    """
+    counts = rki[["Meldetag", "KW", "Bundesland", "Landkreis",
+                  "Altersgruppe"]].copy()
+    for col, flag in [("AnzahlFall", "NeuerFall"),
+                      ("AnzahlTodesfall", "NeuerTodesfall")]:
+        values = np.asarray(rki[col], dtype="int64")
+        if flag in rki:
+            flags = np.asarray(rki[flag])
+            if delta:
+                values = np.where(np.isin(flags, [-1, 1]), values, 0)
+            else:
+                values = np.where(flags != -1, values, 0)
+        counts[col] = values
+    return counts
+
+
+def _datenstand(rki):
+    """Return the publication dates (Datenstand) of the rows of rki."""
+    if "Datenstand" not in rki:
+        return []
+    return sorted(str(x) for x in pd.unique(rki["Datenstand"]))
+
+
+def _months(first, nday):
+    """Return the months and their first positions (last is nday)."""
+    months = day_dates(first + np.arange(nday)).astype("datetime64[M]")
+    labels, starts = np.unique(months, return_index=True)
+    return [str(x) for x in labels], list(starts) + [nday]
+
+
+def _month_file(directory, label):
+    """Return the file of the regional series of a month."""
+    return os.path.join(directory, "regionen_" + label + ".npy")
+
+
+def _write_months(directory, meta, daily, start, base):
+    """Write the regional series of the months from position start on.
+
+    daily contains the daily cases and deaths of all regions from the
+    first day of the month of position start on, base the cumulated values
+    before this day.
+    """
+    labels, bounds = _months(meta["first"], meta["nday"])
+    cumulated = base[:, :, None] + np.cumsum(daily, axis=2)
+    values = np.concatenate([daily, cumulated])
+    p0 = np.searchsorted(bounds, start, side="right") - 1
+    for p in range(p0, len(labels)):
+        _save(_month_file(directory, labels[p]),
+              values[:, :, bounds[p] - bounds[p0]:bounds[p+1] - bounds[p0]])
+
+
+def _update_regions(directory, meta, cube):
+    """Add the daily changes of cube to the regional series of a store."""
+    nday = cube["Fälle"].shape[1]
+    changed = np.flatnonzero(np.any((cube["Fälle"] != 0) |
+                                    (cube["Tote"] != 0), axis=0))
+    if len(changed) == 0:
+        return
+    nold = len(meta["Ebene"])
+    index = {key: k for k, key in enumerate(zip(meta["Ebene"],
+                                                meta["Region"]))}
+    rows = []
+    for key in zip(cube["Ebene"].tolist(), cube["Region"].tolist()):
+        if key not in index:
+            index[key] = len(meta["Ebene"])
+            meta["Ebene"].append(key[0])
+            meta["Region"].append(key[1])
+        rows.append(index[key])
+    rows = np.array(rows)
+    nregion = len(meta["Ebene"])
+    oldfirst = meta["first"]
+    oldlabels, oldbounds = _months(oldfirst, meta["nday"])
+    first = min(oldfirst, cube["first"])
+    last = max(oldfirst + meta["nday"], cube["first"] + nday)
+    meta["first"], meta["nday"] = first, last - first
+
+    # the months from the first changed day on are written again, all
+    # months if regions or earlier days are added
+    if nregion > nold or first < oldfirst:
+        start = 0
+    else:
+        start = cube["first"] + int(changed[0]) - first
+    labels, bounds = _months(first, last - first)
+    p0 = np.searchsorted(bounds, start, side="right") - 1
+    start = bounds[p0]
+    daily = np.zeros((2, nregion, last - first - start), dtype="int64")
+    base = np.zeros((2, nregion), dtype="int64")
+    old = [k for k, label in enumerate(oldlabels) if label >= labels[p0]]
+    if old:
+        values = np.concatenate([np.load(_month_file(directory,
+                                                     oldlabels[k]))[:2]
+                                 for k in old], axis=2)
+        offset = oldfirst + oldbounds[old[0]] - first - start
+        daily[:, :nold, offset:offset + values.shape[2]] = values
+    if p0 > 0:
+        base[:, :nold] = np.load(_month_file(directory,
+                                             labels[p0 - 1]))[2:, :, -1]
+
+    # the days of cube before the first changed day have no changes
+    shift = cube["first"] - first - start
+    values = np.stack([cube["Fälle"], cube["Tote"]])
+    if shift >= 0:
+        daily[:, rows, shift:shift + nday] += values
+    else:
+        daily[:, rows, :nday + shift] += values[:, :, -shift:]
+    _write_months(directory, meta, daily, start, base)
+
+
+def _update_weeks(directory, meta, pivot):
+    """Add the changes of pivot to the age groups by week of a store."""
+    nold = len(meta["Altersgruppe"])
+    rows = []
+    for name in pivot["Altersgruppe"].tolist():
+        if name not in meta["Altersgruppe"]:
+            meta["Altersgruppe"].append(name)
+        rows.append(meta["Altersgruppe"].index(name))
+    nage = len(meta["Altersgruppe"])
+    changed = np.any((pivot["Fälle"] != 0) | (pivot["Tote"] != 0), axis=0)
+    weeks = set(pivot["KW"][changed].tolist())
+    if nage > nold:
+        weeks |= set(meta["KW"])
+    columns = {week: k for k, week in enumerate(pivot["KW"].tolist())}
+    for week in sorted(weeks):
+        filename = os.path.join(directory, "kw_" + str(week) + ".npy")
+        values = np.zeros((2, nage), dtype="int64")
+        if week in meta["KW"]:
+            values[:, :nold] = np.load(filename)
+        if week in columns:
+            values[0, rows] += pivot["Fälle"][:, columns[week]]
+            values[1, rows] += pivot["Tote"][:, columns[week]]
+        _save(filename, values)
+    meta["KW"] = sorted(set(meta["KW"]) | weeks)
+
+
+def _load_meta(directory):
+    """Read the description of a store."""
+    with open(os.path.join(directory, "meta.json")) as f:
+        return json.load(f)
+
+
+def _save_meta(directory, meta):
+    """Write the description of a store."""
+    filename = os.path.join(directory, "meta.json")
+    with open(filename + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def _save(filename, values):
+    """Write an array to filename, an existing file is replaced."""
+    with open(filename + ".tmp", "wb") as f:
+        np.save(f, values)
+    os.replace(filename + ".tmp", filename)
+
+
+def _codes(values):
+    """Return the integer codes and the names of a text column."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return (np.asarray(values.cat.codes, dtype="int64"),
+                np.asarray(values.cat.categories))
+    codes, names = pd.factorize(values)
+    return codes.astype("int64"), np.asarray(names)
+
+
+def save_columns(directory, frame):
+    """Write the columns of a dataframe to .npy files in directory.
+
+    The directory is written under a temporary name and renamed when it is
+    complete, existing files are replaced.
+    """
+    tmpdir = directory + ".tmp" + str(os.getpid())
+    os.makedirs(tmpdir, exist_ok=True)
+    columns = []
+    for k, col in enumerate(frame.columns):
+        values = frame[col]
+        entry = {"name": col, "file": "c" + str(k)}
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            entry["kind"] = "category"
+            categories = np.asarray(values.cat.categories)
+            if categories.dtype == object:
+                categories = categories.astype(str)
+            np.save(os.path.join(tmpdir, entry["file"] + "_cat.npy"),
+                    categories)
+            values = values.cat.codes
+        elif np.issubdtype(values.dtype, np.datetime64):
+            entry["kind"] = "datetime"
+            values = values.values.astype("datetime64[D]").astype("int32")
+        else:
+            entry["kind"] = "array"
+            values = np.asarray(values)
+            if values.dtype == object:
+                values = values.astype(str)
+        np.save(os.path.join(tmpdir, entry["file"] + ".npy"),
+                np.asarray(values))
+        columns.append(entry)
+    with open(os.path.join(tmpdir, "columns.json"), "w") as f:
+        json.dump(columns, f)
+    open(os.path.join(tmpdir, "complete"), "w").close()
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmpdir, directory)
+
+
+def load_columns(directory):
+    """Read a dataframe written by save_columns."""
+    with open(os.path.join(directory, "columns.json")) as f:
+        columns = json.load(f)
+    frame = {}
+    for entry in columns:
+        values = np.load(os.path.join(directory, entry["file"] + ".npy"))
+        if entry["kind"] == "category":
+            categories = np.load(os.path.join(directory,
+                                              entry["file"] + "_cat.npy"))
+            values = pd.Categorical.from_codes(values, categories)
+        elif entry["kind"] == "datetime":
+            values = day_dates(values)
+        frame[entry["name"]] = values
+    return pd.DataFrame(frame)
+
+
+def _file_hash(filename, cache):
+    """Return the hash of a file.
+
+    The hash is remembered in cache/hashes.json with the size and the
+    modification time of the file and only calculated again if these
+    change.
+    """
+    os.makedirs(cache, exist_ok=True)
+    index = os.path.join(cache, "hashes.json")
+    hashes = {}
+    if os.path.exists(index):
+        with open(index) as f:
+            hashes = json.load(f)
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    known = hashes.get(path)
+    if known is not None and known["size"] == stat.st_size and\
+            known["mtime"] == stat.st_mtime_ns:
+        return known["hash"]
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    hashes[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                    "hash": digest.hexdigest()[:16]}
+    with open(index, "w") as f:
+        json.dump(hashes, f)
+    return hashes[path]["hash"]
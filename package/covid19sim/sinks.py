@@ -0,0 +1,79 @@
+"""Sinks for the results of a simulation.
+
+A sink receives the tables of a simulation run with write(name, params,
+results, groupresults):
+
+params : dataframe with the parameters of the run
+results : overview with peaks and sums
+groupresults : daily results
+"""
+import os
+import pandas as pd
+
+# Names of the tables, used as Excel sheet names
+TABLES = ["Parameter", "Ergebnisübersicht", "Zustand pro Tag"]
+
+
+class ExcelSink:
+    """Write the tables to the sheets of datadir/name.xlsx."""
+
+    def __init__(self, datadir="."):
+        self.datadir = datadir
+
+    def write(self, name, params, results, groupresults):
+        excelfile = os.path.join(self.datadir, name + ".xlsx")
+        writer = pd.ExcelWriter(excelfile, engine='xlsxwriter')
+        for table, frame in zip(TABLES, [params, results, groupresults]):
+            frame.to_excel(writer, sheet_name=table, index=False)
+        writer.close()
+
+
+class CSVSink:
+    """Write the tables to datadir/name_<table>.csv."""
+
+    def __init__(self, datadir=".", **kwargs):
+        self.datadir = datadir
+        self.kwargs = kwargs
+
+    def write(self, name, params, results, groupresults):
+        for table, frame in zip(TABLES, [params, results, groupresults]):
+            frame.to_csv(os.path.join(self.datadir, _filename(name, table) +
+                                      ".csv"), index=False, **self.kwargs)
+
+
+class ParquetSink:
+    """Write the tables to datadir/name_<table>.parquet.
+
+    Requires pyarrow or fastparquet.
+    """
+
+    def __init__(self, datadir="."):
+        self.datadir = datadir
+
+    def write(self, name, params, results, groupresults):
+        # the values of the parameters have mixed types
+        params = params.astype({"Wert": str})
+        for table, frame in zip(TABLES, [params, results, groupresults]):
+            frame.to_parquet(os.path.join(self.datadir,
+                                          _filename(name, table) +
+                                          ".parquet"), index=False)
+
+
+class MemorySink:
+    """Keep the tables in memory.
+
+    tables is a dictionary with the name of the run as key and a dictionary
+    of the tables as value.
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def write(self, name, params, results, groupresults):
+        self.tables[name] = dict(zip(TABLES, [params, results, groupresults]))
+
+
+def _filename(name, table):
+    """Return the file name of a table of the run name."""
+    table = table.replace("ü", "ue").replace(" ", "_")
+    return name + "_" + table
@@ -0,0 +1,193 @@
+"""Simulation of scenario trees with a shared history."""
+import os
+import shutil
+import tempfile
+import datetime
+import inspect
+import numpy as np
+from covid19sim import coronalib
+from covid19sim.parallel import _collect, _scale_r
+
+# Keyword arguments of sim which may differ between the scenarios of a tree
+_CHANGES = ["r_change", "com_attack_rate"]
+
+
+def scenario_tree(grid, population, seed=None, datadir=None):
+    """Simulate scenarios which only differ in their change points.
+
+    The scenarios are arranged in a tree. The history shared by a group of
+    scenarios up to the first change point where they differ is simulated
+    once, the state is copied at this change point and each branch is
+    continued from the copy. The results of each scenario are identical to
+    a separate run of sim with the same seed.
+
+    Parameters
+    ----------
+    grid : list of dictionaries with the keyword arguments of sim for each
+        scenario. All arguments except r_change and com_attack_rate must be
+        the same, values of r_change may be numbers as in sweep.
+    population : dictionary or SharedPopulation with the arrays "age",
+        "drate" and optionally "contacts" and "hnr"
+    seed : seed of the random numbers of all scenarios, if None the global
+        numpy random state at the call is used for all scenarios
+    datadir : directory of the checkpoints, by default a temporary
+        directory which is removed afterwards
+
+    Returns
+    -------
+    results : daily results of all scenarios as a dataframe with the
+        additional column "Szenario" (position in the grid) and the numeric
+        and text parameters of each scenario
+    """
+    common = {key: value for key, value in grid[0].items()
+              if key not in _CHANGES}
+    for scenario in grid:
+        other = {key: value for key, value in scenario.items()
+                 if key not in _CHANGES}
+        if other.keys() != common.keys() or not all(
+                _same(other[key], common[key]) for key in common):
+            raise ValueError("The scenarios of a tree may only differ in "
+                             "r_change and com_attack_rate")
+    if "nrep" in common or "resume" in common:
+        raise ValueError("nrep and resume are not supported in a tree")
+    day0date = common.get("day0date", inspect.signature(
+        coronalib.sim).parameters["day0date"].default)
+    plans = [_plan(scenario, day0date) for scenario in grid]
+
+    tmpdir = None
+    if datadir is None:
+        tmpdir = datadir = tempfile.mkdtemp()
+    tree = {"grid": grid, "population": population, "common": common,
+            "plans": plans, "seed": seed, "datadir": datadir, "nodes": 0,
+            "frames": [None] * len(grid)}
+    if seed is None:
+        tree["rngstate"] = np.random.get_state()
+    try:
+        # change points before day 1 can not be forked, the first change
+        # of each parameter is used from day 0 on
+        roots = _groups(plans, range(len(grid)),
+                        [day for plan in plans for day in plan if day < 1] +
+                        [day for plan in plans
+                         for day in _first_days(plan).values()])
+        for members in roots:
+            _branch(tree, members, 1, None)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return _collect(grid, tree["frames"])
+
+
+def _same(a, b):
+    """Compare two parameter values."""
+    if a is b:
+        return True
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    return a == b
+
+
+def _plan(scenario, day0date):
+    """Return the change points of a scenario.
+
+    Returns
+    -------
+    plan : dictionary with the change day relative to day0date as key and a
+        dictionary with the changed parameters and their (date, value) as
+        value
+    """
+    plan = {}
+    for param in _CHANGES:
+        for key, value in scenario.get(param, {}).items():
+            day = (datetime.datetime.strptime(key, "%Y-%m-%d").date() -
+                   day0date).days
+            plan.setdefault(day, {})[param] = (key, value)
+    return plan
+
+
+def _first_days(plan):
+    """Return the day of the first change of each parameter of a plan."""
+    first = {}
+    for day in sorted(plan):
+        for param in plan[day]:
+            first.setdefault(param, day)
+    return first
+
+
+def _groups(plans, members, days):
+    """Group the scenarios with the same changes at the given days."""
+    groups = []
+    for k in members:
+        for group in groups:
+            if all(_same_change(plans[k].get(day, {}),
+                                plans[group[0]].get(day, {}))
+                   for day in days):
+                group.append(k)
+                break
+        else:
+            groups.append([k])
+    return groups
+
+
+def _same_change(a, b):
+    """Compare the changed parameters of two scenarios at one day."""
+    return a.keys() == b.keys() and all(_same(a[x][1], b[x][1]) for x in a)
+
+
+def _branch(tree, members, day, resume):
+    """Simulate the scenarios in members, which share all changes before day,
+    starting from the checkpoint resume."""
+    plans = tree["plans"]
+    days = sorted({x for k in members for x in plans[k] if x >= day})
+    for fork_day in days:
+        groups = _groups(plans, members, [fork_day])
+        if len(groups) > 1:
+            break
+    else:
+        fork_day = None
+
+    frame, forkfile = _run(tree, members[0], fork_day, resume)
+    if fork_day is None or not os.path.exists(forkfile):
+        # no further differences or the change point was not reached
+        for k in members:
+            tree["frames"][k] = frame.copy()
+        return
+    for group in groups:
+        _branch(tree, group, fork_day, forkfile)
+
+
+def _run(tree, k, fork_day, resume):
+    """Simulate scenario k with the changes before fork_day and the first
+    change of each parameter."""
+    tree["nodes"] += 1
+    name = "Knoten " + str(tree["nodes"])
+    kwargs = dict(tree["common"])
+    kwargs["r_change"] = {}
+    kwargs["com_attack_rate"] = {}
+    first = _first_days(tree["plans"][k])
+    for day, changes in tree["plans"][k].items():
+        for param, (key, value) in changes.items():
+            if fork_day is None or day < fork_day or first[param] == day:
+                kwargs[param][key] = value
+    kwargs["r_change"] = _scale_r(kwargs["r_change"], tree["population"])
+    kwargs.update(simname=name, datadir=tree["datadir"],
+                  seed=_fresh_seed(tree["seed"]), resume=resume,
+                  fork_day=fork_day, sinks=[])
+    if tree["seed"] is None and resume is None:
+        np.random.set_state(tree["rngstate"])
+    forkfile = os.path.join(tree["datadir"], name + "_fork.ckpt")
+    if os.path.exists(forkfile):
+        os.remove(forkfile)
+    population = tree["population"]
+    if "hnr" in population:
+        kwargs.setdefault("hnr", population["hnr"])
+    out = coronalib.sim(population["age"], population["drate"], **kwargs)
+    return out[6].reset_index(drop=True), forkfile
+
+
+def _fresh_seed(seed):
+    """Return a copy of a SeedSequence without spawned children, so that
+    each node draws the same streams as a separate run of sim."""
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key,
+                                      pool_size=seed.pool_size)
+    return seed
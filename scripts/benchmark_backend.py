@@ -0,0 +1,46 @@
+"""Compare the run time of the numpy and numba backends of sim."""
+import sys
+import time
+import tempfile
+import datetime
+import numpy as np
+import pandas as pd
+import covid19sim.coronalib as cl
+
+nday = 120
+sizes = [int(x) for x in sys.argv[1:]] or [1000000, 17900000]
+datadir = tempfile.mkdtemp()
+
+res = []
+for n in sizes:
+    age, agegroup, gender, contacts, drate, hnr, persons = cl.makepop(
+        "current", n)
+    age = np.array(age)
+    drate = np.array(drate)
+    contacts = np.array(contacts)
+    for backend in ["numpy", "numba"]:
+        for lean in [False, True]:
+            r_change = {}
+            r_change['2020-01-01'] = 3 * contacts/np.mean(contacts)
+            r_change['2020-03-16'] = 0.6 * contacts/np.mean(contacts)
+            com_attack_rate = {"2020-01-01": 0.0}
+            np.random.seed(1)
+            tstart = time.time()
+            state, statesum, infections, day0, rnow, args, gr = cl.sim(
+                age, drate, nday=nday, prob_icu=0.009, day0cumrep=450,
+                mean_days_to_icu=16, mean_duration_icu=14,
+                mean_time_to_death=21, mean_serial=7.5, std_serial=3.0,
+                ifr=0.003, hnr=None, com_attack_rate=com_attack_rate,
+                r_change=r_change, simname="benchmark", datadir=datadir,
+                rep_delay=13, alpha=0.125,
+                day0date=datetime.date(2020, 3, 8), lean=lean,
+                backend=backend)
+            res.append({"n": n, "backend": backend, "lean": lean,
+                        "Laufzeit": time.time() - tstart,
+                        "Speicher (MB)": args["peak_memory_mb"],
+                        "Tote": statesum[7, -1]})
+
+res = pd.DataFrame(res)
+res["Speedup"] = res.groupby(["n", "lean"]).Laufzeit.transform("first") /\
+    res.Laufzeit
+print(res.to_string(index=False))
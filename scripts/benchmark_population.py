@@ -0,0 +1,28 @@
+"""Measure the build time and memory of the populations of makepop."""
+import sys
+import time
+import tracemalloc
+import pandas as pd
+import covid19sim.coronalib as cl
+
+sizes = [int(x) for x in sys.argv[1:]] or [1000000, 17900000, 83000000]
+
+res = []
+tracemalloc.start()
+for n in sizes:
+    for popname in ["current", "household"]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        tstart = time.time()
+        population = cl.makepop(popname, n)
+        runtime = time.time() - tstart
+        peak = tracemalloc.get_traced_memory()[1] - base
+        res.append({"n": n, "Population": popname, "Laufzeit": runtime,
+                    "Spitze (MB)": peak / 2**20,
+                    "Spalten (MB)": sum(x.nbytes for x in population
+                                        if x is not None) / 2**20,
+                    "Personen": len(population[0])})
+        del population
+
+res = pd.DataFrame(res)
+print(res.to_string(index=False))
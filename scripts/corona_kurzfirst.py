@@ -1,5 +1,6 @@
 """Simulation of infections for different scenarios."""
 import covid19sim.coronalib as cl
+from covid19sim.rki import load_rki
 import pandas as pd
 import numpy as np
 import plotly.express as px
@@ -14,28 +15,25 @@ age, agegroup, gender, contacts, drate, hnr, persons = cl.makepop("household",
                                                                   1790000)
 
 day0date = datetime.date(2020, 3, 8)
-rki = pd.read_csv("../data/RKI_COVID19.csv")
-rki["Meldedatum"] = pd.to_datetime(rki.Meldedatum, infer_datetime_format=True)
-rki["Meldedatum"] = rki["Meldedatum"].dt.date
-rki["Refdatum"] = pd.to_datetime(rki.Refdatum, infer_datetime_format=True)
-rki["Refdatum"] = rki["Refdatum"].dt.date
-rki["KW"] = [x.isocalendar()[1] for x in rki.Meldedatum]
-rki["Delta"] = (rki["Meldedatum"]-rki["Refdatum"]).dt.days
+rki = load_rki("../data/RKI_COVID19.csv", cache="../data/cache")
+rki["Delta"] = rki["Meldetag"]-rki["Reftag"]
 
 brd = rki.copy()
-brd = brd.groupby(["Meldedatum", "Altersgruppe"]).agg(Fälle=("AnzahlFall",
-                                                             "sum"))
+brd = brd.groupby(["Meldedatum", "Altersgruppe"], observed=True).agg(
+    Fälle=("AnzahlFall", "sum"))
 brd.reset_index(inplace=True)
 brd = brd.pivot_table(values="Fälle", index="Meldedatum", columns="Altersgruppe",
-                margins=True, aggfunc="sum", fill_value=0, margins_name="Fälle")
+                margins=True, aggfunc="sum", fill_value=0, margins_name="Fälle",
+                observed=True)
 brd.drop(labels="Fälle",inplace=True)
 brd.reset_index(inplace=True)
 brd["Fälle_kum"] = np.cumsum(brd.Fälle)
 brd["day"] = (brd.Meldedatum - min(brd.Meldedatum)).dt.days
+brd["Meldedatum"] = brd.Meldedatum.dt.date
 day0 = np.argmax(brd["Meldedatum"] == day0date)
 brd["day"] = brd["day"] - brd["day"][day0]
 
-brd_tote = pd.DataFrame({"Datum": [max(rki.Meldedatum)],
+brd_tote = pd.DataFrame({"Datum": [max(rki.Meldedatum).date()],
                          "Tote": [np.sum(rki.AnzahlTodesfall)],
                          "Intensiv": [np.NaN]
                          })
@@ -46,15 +44,17 @@ brd.rename(columns={"Tote_kum": "cumdeath"}, inplace=True)
 brd.to_excel("./brd_dat.xlsx", index=False)
 
 nrw = rki[(rki.Bundesland == 'Nordrhein-Westfalen')].copy()
-nrw = nrw.groupby(["Meldedatum", "Altersgruppe"]).agg(Fälle=("AnzahlFall",
-                                                             "sum"))
+nrw = nrw.groupby(["Meldedatum", "Altersgruppe"], observed=True).agg(
+    Fälle=("AnzahlFall", "sum"))
 nrw.reset_index(inplace=True)
 nrw = nrw.pivot_table(values="Fälle", index="Meldedatum", columns="Altersgruppe",
-                margins=True, aggfunc="sum", fill_value=0, margins_name="Fälle")
+                margins=True, aggfunc="sum", fill_value=0, margins_name="Fälle",
+                observed=True)
 nrw.drop(labels="Fälle",inplace=True)
 nrw.reset_index(inplace=True)
 nrw["Fälle_kum"] = np.cumsum(nrw.Fälle)
 nrw["day"] = (nrw.Meldedatum - min(nrw.Meldedatum)).dt.days
+nrw["Meldedatum"] = nrw.Meldedatum.dt.date
 day0 = np.argmax(nrw["Meldedatum"] == day0date)
 nrw["day"] = nrw["day"] - nrw["day"][day0]
 
@@ -8,31 +8,24 @@ Created on Mon Mar 23 09:24:33 2020
 import numpy as np
 import pandas as pd
 import coronalib as cl
-import scipy.stats 
 from scipy.optimize import minimize
-import datetime
+from covid19sim.convolution import delay_convolve, delay_kernel
+from covid19sim.rki import load_rki, aggregate_regions
 
 def ifr(repo, deaths, delay):
-    pdf = [scipy.stats.poisson.pmf(i, delay) for i in range(0, 200)]
-    expected = np.zeros(shape=repo.shape[0])
-    tmax = repo.shape[0]
-    for t in range(0, tmax):
-        for s in range(0, t):
-            expected[t] = expected[t] + repo[t-s] * pdf[s]
+    # delay may be a list, then the rows of cumexpec belong to the delays
+    pdf = np.reshape([delay_kernel("poisson", (d,), 200)
+                      for d in np.ravel(delay)], np.shape(delay) + (200,))
+    expected = delay_convolve(repo, pdf)
     cumdeaths = np.cumsum(deaths)
-    cumexpec = np.cumsum(expected)
+    cumexpec = np.cumsum(expected, axis=-1)
     return cumdeaths, cumexpec
 
 
 def l2(x, repo, deaths):
     lamb, cfr = x[0], x[1]
-    pdf = [scipy.stats.poisson.pmf(i, lamb) for i in range(0, 200)]
-    expected = np.zeros(shape=repo.shape[0])
-    expected[0] = 0
-    for t in range(1, len(repo)):
-        expected[t] = 0
-        for s in range(0, t):
-            expected[t] = expected[t] + repo[t-s] * pdf[s]
+    pdf = delay_kernel("poisson", (lamb,), 200)
+    expected = delay_convolve(repo, pdf)
     expected = expected * cfr
     return np.mean(np.abs(expected-deaths))
 
@@ -71,52 +64,12 @@ italy["Country/Region"] = "Italy"
 cases = pd.concat([cases, italy])
 
 # Deutschland einlesen
-rki = pd.read_csv("../data/RKI_COVID19.csv")
-rki["Meldedatum"] = pd.to_datetime(rki.Meldedatum, infer_datetime_format=True)
-rki["Meldedatum"] = rki["Meldedatum"].dt.date
-mindate = min(rki.Meldedatum)
-maxdate = max(rki.Meldedatum)
-ndays = (maxdate-mindate).days
-datedf = pd.DataFrame({"Meldedatum": [mindate + datetime.timedelta(days=i)
-                                 for i in range(0,ndays+1)]})
-
-germany = rki.groupby(["Meldedatum"]).agg(
-    Tote=('AnzahlTodesfall', 'sum'), Fälle=("AnzahlFall", "sum"))
-germany = datedf.merge(germany, on="Meldedatum", how="left")
-germany.fillna(0, inplace=True)
-germany["Fälle_kum"] = np.cumsum(germany.Fälle)
-germany["Tote_kum"] = np.cumsum(germany.Tote)
-germany["Country/Region"] = "Deutschland"
-germany["Province/State"] = "None"
-germany.reset_index(inplace=True)
-
-regionen = [germany]
-for bl in rki.Bundesland.unique():
-    bundesland = rki[rki.Bundesland == bl].copy()
-    bundesland = bundesland.groupby(["Meldedatum"]).agg(
-        Tote=('AnzahlTodesfall', 'sum'), Fälle=("AnzahlFall", "sum"))
-    bundesland = datedf.merge(bundesland, on="Meldedatum", how="left")
-    bundesland.fillna(0, inplace=True)
-    bundesland["Fälle_kum"] = np.cumsum(bundesland.Fälle)
-    bundesland["Tote_kum"] = np.cumsum(bundesland.Tote)
-    bundesland["Country/Region"] = "Deutschland"
-    bundesland["Province/State"] = bl
-    bundesland.reset_index(inplace=True)
-    regionen.append(bundesland)
-
-for bl in rki.Landkreis.unique():
-    bundesland = rki[rki.Landkreis == bl].copy()
-    bundesland = bundesland.groupby(["Meldedatum"]).agg(
-        Tote=('AnzahlTodesfall', 'sum'), Fälle=("AnzahlFall", "sum"))
-    bundesland = datedf.merge(bundesland, on="Meldedatum", how="left")
-    bundesland.fillna(0, inplace=True)
-    bundesland["Fälle_kum"] = np.cumsum(bundesland.Fälle)
-    bundesland["Tote_kum"] = np.cumsum(bundesland.Tote)
-    bundesland["Country/Region"] = "Deutschland"
-    bundesland["Province/State"] = bl
-    bundesland.reset_index(inplace=True)
-    regionen.append(bundesland)
-regionen = pd.concat(regionen)
+rki = load_rki("../data/RKI_COVID19.csv", cache="../data/cache")
+regionen = aggregate_regions(rki)
+regionen["Country/Region"] = "Deutschland"
+regionen["Province/State"] = np.where(regionen.Ebene == "Land", "None",
+                                      regionen.Region)
+regionen.drop(columns=["Region", "Ebene"], inplace=True)
 regionen.rename(columns={"Meldedatum": "date", "Fälle_kum": "reported",
                         "Tote_kum": "deaths"}, inplace=True)
 regionen.drop(columns=["Tote", "Fälle"], inplace=True)
@@ -172,9 +125,10 @@ for index, row in aux.iterrows():
         cres["Land"] = row["Country/Region"]
         cres["Region"] = row["Province/State"]
         cres["crude"] = np.array(country.deaths)[-6] / np.array(country.reported)[-6]
-        for i in [2,4,6,8,10,12]:
-            e,d = ifr(repo,deaths,i)
-            cres[i] = e[-6] / d[-6]
+        delays = [2,4,6,8,10,12]
+        e,d = ifr(repo,deaths,delays)
+        for i, cumexp in zip(delays, d):
+            cres[i] = e[-6] / cumexp[-6]
         res[k] = cres
 
 res = pd.DataFrame.from_dict(res,orient="index")
@@ -1,16 +1,12 @@
 import covid19sim.coronalib as cl
+from covid19sim.rki import load_rki
 import pandas as pd 
 import numpy as np
 import plotly.express as px
 import os
 
-rki = pd.read_csv("../data/RKI_COVID19.csv")
-rki["Meldedatum"] = pd.to_datetime(rki.Meldedatum, infer_datetime_format=True)
-rki["Meldedatum"] = rki["Meldedatum"].dt.date
-rki["Refdatum"] = pd.to_datetime(rki.Refdatum, infer_datetime_format=True)
-rki["Refdatum"] = rki["Refdatum"].dt.date
-rki["KW"] = [x.isocalendar()[1] for x in rki.Meldedatum]
-rki["Delta"] = (rki["Meldedatum"]-rki["Refdatum"]).dt.days
+rki = load_rki("../data/RKI_COVID19.csv", cache="../data/cache")
+rki["Delta"] = rki["Meldetag"]-rki["Reftag"]
 bl = pd.read_csv("../data/RKI_Corona_Landkreise.csv", sep=",")
 rki = rki.merge(bl[["RS", "EWZ", "Shape__Area", "GEN"]],
                 left_on="IdLandkreis", right_on="RS", how="left")
@@ -20,7 +16,7 @@ rki["Anzahl_Delta!=0"] = np.where(rki.Delta != 0, rki.AnzahlFall, 0)
 rki["Delta_Sum"] = rki.Delta*rki.AnzahlFall
 
 
-lk = rki.groupby(["Landkreis", "KW"]).agg(
+lk = rki.groupby(["Landkreis", "KW"], observed=True).agg(
     AnzahlTodesfall=("AnzahlTodesfall", "sum"),
     AnzahlFall=("AnzahlFall", "sum"),
     EWZ=("EWZ", "max"),
@@ -1,4 +1,6 @@
 import covid19sim.coronalib as cl
+from covid19sim.rki import (load_rki, store_exists, build_store, update_store,
+                            load_cube, load_pivots, cube_frame)
 import pandas as pd 
 import numpy as np
 import plotly.express as px
@@ -25,13 +27,8 @@ import plotly.graph_objects as go
 # 
 # =============================================================================
 
-rki = pd.read_csv("../data/RKI_COVID19.csv")
-rki["Meldedatum"] = pd.to_datetime(rki.Meldedatum, infer_datetime_format=True)
-rki["Meldedatum"] = rki["Meldedatum"].dt.date
-rki["Refdatum"] = pd.to_datetime(rki.Refdatum, infer_datetime_format=True)
-rki["Refdatum"] = rki["Refdatum"].dt.date
-rki["KW"] = [x.isocalendar()[1] for x in rki.Meldedatum]
-rki["Meldeverzug"] = (rki["Meldedatum"]-rki["Refdatum"]).dt.days
+rki = load_rki("../data/RKI_COVID19.csv", cache="../data/cache")
+rki["Meldeverzug"] = rki["Meldetag"]-rki["Reftag"]
 rki["Meldeverzug"] = np.where(rki.IstErkrankungsbeginn == 0, np.NaN,
                               rki["Meldeverzug"])
 rki["VorErkrankung"] = np.where(rki["Meldeverzug"] < 0, rki.AnzahlFall, 0)
@@ -54,7 +51,7 @@ rki["Alter"] = np.where(rki.Altersgruppe == "A35-A59", 47, rki["Alter"])
 rki["Alter"] = np.where(rki.Altersgruppe == "A60-A79", 70, rki["Alter"])
 rki["Alter"] = np.where(rki.Altersgruppe == "A80+", 85, rki["Alter"])
 
-lk = rki.groupby("Landkreis").agg(
+lk = rki.groupby("Landkreis", observed=True).agg(
     AnzahlTodesfall=("AnzahlTodesfall", "sum"),
     AnzahlFall=("AnzahlFall", "sum"),
     EWZ=("EWZ", "max"),
@@ -92,46 +89,22 @@ df["Altersgruppe"] = np.where(age > 79, "A80+", df.Altersgruppe)
 agpop = df.groupby("Altersgruppe").agg(Anteil_Pop=("Alter", "count"),
                                        Sterberate=("Sterberate", "mean"))
 
-germany = rki.groupby(["Meldedatum"]).agg(
-    Tote=('AnzahlTodesfall', 'sum'), Fälle=("AnzahlFall", "sum"))
-germany["Fälle_kum"] = np.cumsum(germany.Fälle)
-germany["Tote_kum"] = np.cumsum(germany.Tote)
-germany["Region"] = "Deutschland"
-germany["Ebene"] = "Land"
-germany.reset_index(inplace=True)
-
-regionen = [germany]
-for bl in rki.Bundesland.unique():
-    bundesland = rki[rki.Bundesland == bl].copy()
-    bundesland = bundesland.groupby(["Meldedatum"]).agg(
-        Tote=('AnzahlTodesfall', 'sum'), Fälle=("AnzahlFall", "sum"))
-    bundesland["Fälle_kum"] = np.cumsum(bundesland.Fälle)
-    bundesland["Tote_kum"] = np.cumsum(bundesland.Tote)
-    bundesland["Region"] = bl
-    bundesland["Ebene"] = "Bundesland"
-    bundesland.reset_index(inplace=True)
-    regionen.append(bundesland)
-
-for bl in rki.Landkreis.unique():
-    bundesland = rki[rki.Landkreis == bl].copy()
-    bundesland = bundesland.groupby(["Meldedatum"]).agg(
-        Tote=('AnzahlTodesfall', 'sum'), Fälle=("AnzahlFall", "sum"))
-    bundesland["Fälle_kum"] = np.cumsum(bundesland.Fälle)
-    bundesland["Tote_kum"] = np.cumsum(bundesland.Tote)
-    bundesland["Region"] = bl
-    bundesland["Ebene"] = "Landkreis"
-    bundesland.reset_index(inplace=True)
-    regionen.append(bundesland)
-
-regionen = pd.concat(regionen)
+# regional series and age groups by week, updated with the changes of the
+# new publication if the store exists
+store = "../data/cache/regionen"
+if store_exists(store) and os.path.exists("../data/RKI_COVID19_delta.csv"):
+    update_store(store, load_rki("../data/RKI_COVID19_delta.csv"))
+else:
+    build_store(store, rki)
+regionen = cube_frame(load_cube(store))
+pivots = load_pivots(store)
 regionen.to_excel("../data/RKI_COVID19_Kum.xlsx", index=False)
 
 nrw = regionen[regionen.Region == 'Nordrhein-Westfalen']
 
 #rki = rki[rki.Bundesland == "Nordrhein-Westfalen"]
 writer = pd.ExcelWriter("../data/agnew.xlsx")
-ag = rki.pivot_table(columns="KW", index="Altersgruppe",
-        values="AnzahlFall", aggfunc="sum", fill_value=0)
+ag = pivots["Fälle"]
 ag = ag.merge(agpop, on="Altersgruppe", how="left")
 ag = ag.transpose()
 ag["All"] = ag["All"] = ag.sum(axis=1)
@@ -143,8 +116,7 @@ for c in rki.Altersgruppe.unique():
 
 ag.to_excel(writer, sheet_name="Fälle_Anteil", index=False)
 
-ag = rki.pivot_table(columns="KW", index="Altersgruppe",
-                     values="AnzahlTodesfall", aggfunc="sum", fill_value=0)
+ag = pivots["Tote"]
 ag = ag.merge(agpop, on="Altersgruppe", how="left")
 ag = ag.transpose()
 ag["All"] = ag["All"] = ag.sum(axis=1)
@@ -156,7 +128,7 @@ for c in rki.Altersgruppe.unique():
 
 ag.to_excel(writer, sheet_name="Tote_anteil", index=False)
 
-lastcase = rki.groupby("Landkreis").agg(
+lastcase = rki.groupby("Landkreis", observed=True).agg(
         AnzahlFall=("AnzahlFall", "sum"),
         LetzerFall=("Refdatum", "max"),
         LetzeMeldung=("Meldedatum", "max")